@@ -4,10 +4,16 @@ import os
 import sys
 
 import argparse
+import collections
+import json
+import multiprocessing
 import psycopg2
-import select
+import random
 import re
+import struct
+import subprocess
 import time 
+import zlib
 
 
 # check if illegal chars are present in string
@@ -56,10 +62,10 @@ def postgres_connect( db, creds_file ):
 # process each line of annotation file
 # param: string representing line of file
 # param: argparse object
-# return: tuple of variant name, annotation value
+# return: list of variant name followed by one annotation value per feature
 def process_line( line, args ):
     line = line.strip()
-    if not line: return snp2value
+    if not line: return None
     
     if args.header_starter:
         if line.startswith( args.header_starter ): return None
@@ -68,6 +74,16 @@ def process_line( line, args ):
 
     snp_name = fields[args.snp_name_column]
 
+    if args.feature_map:
+        row = [ snp_name ]
+        for value_column, feature, datatype in args.features:
+            # if value is missing, substitute default_value
+            if len( fields ) < ( value_column + 1 ):
+                row.append( args.default_value )
+            else:
+                row.append( fields[value_column] )
+        return row
+
     if args.db_column_datatype.lower() == 'boolean':
         if not args.present_snp_value:
             sys.stderr.write( "specify --present_snp_value\n" )
@@ -84,33 +100,1316 @@ def process_line( line, args ):
     return [ snp_name, value ]
 
 
-# for summary table, get range of values in annotation
+# read-only file-like object over an iterator of strings, so rows can be 
+# streamed to COPY, and decompressed input to the parser, without holding 
+# the whole stream in memory
+class IteratorFile( object ):
+    def __init__( self, lines, on_close=None ):
+        self.lines = lines
+        self.buf = ''
+        self.pos = 0
+        self.on_close = on_close
+
+    # append strings from the iterator to the buffer. strings are collected
+    # until size bytes are buffered and joined once, rather than copying the
+    # buffer for every string.
+    # return: False if the iterator ended before anything was added
+    def fill( self, size ):
+        parts = [ self.buf[self.pos:] ]
+        n = len( parts[0] )
+        added = False
+        for data in self.lines:
+            parts.append( data )
+            n += len( data )
+            added = True
+            if n >= size: break
+        if added:
+            self.buf = ''.join( parts )
+            self.pos = 0
+        return added
+
+    def read( self, size=-1 ):
+        if size < 0:
+            while self.fill( sys.maxint ): pass
+            size = len( self.buf ) - self.pos
+        elif len( self.buf ) - self.pos < size:
+            self.fill( size )
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len( data )
+        return data
+
+    def readline( self ):
+        searched = 0
+        while True:
+            end = self.buf.find( '\n', self.pos + searched )
+            if end >= 0:
+                line = self.buf[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+            # the buffer is rebuilt from pos by fill, so search on from there
+            searched = len( self.buf ) - self.pos
+            if not self.fill( searched + 1 ):
+                return self.read()
+
+    # whole lines totalling about sizehint bytes
+    def readlines( self, sizehint=None ):
+        if not sizehint:
+            sizehint = READ_SIZE
+        if len( self.buf ) - self.pos < sizehint:
+            self.fill( sizehint )
+        end = self.buf.rfind( '\n', self.pos, self.pos + sizehint )
+        if end < 0:
+            end = self.buf.find( '\n', self.pos )
+        if end < 0:
+            end = len( self.buf ) - 1
+        lines = self.buf[self.pos:end + 1].splitlines( True )
+        self.pos = end + 1
+        return lines
+
+    def close( self ):
+        if self.on_close:
+            self.on_close()
+
+
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+# bytes read from compressed files at a time
+READ_SIZE = 1 << 20
+# BGZF blocks, of up to 64KB each, decompressed per task
+BGZF_BATCH_BLOCKS = 64
+
+
+# detect compression from the magic bytes; BGZF is gzip with a 'BC' extra field
+# param: string, file path
+# return: 'gzip', 'bgzf', 'zstd' or None
+def get_compression( filename ):
+    fh = open( filename, 'rb' )
+    head = fh.read( 16 )
+    fh.close()
+
+    if head.startswith( ZSTD_MAGIC ):
+        return 'zstd'
+    if head.startswith( GZIP_MAGIC ):
+        if len( head ) == 16 and ord( head[3] ) & 4 and head[12:14] == 'BC':
+            return 'bgzf'
+        return 'gzip'
+    return None
+
+
+# param: file object
+# yields: strings of up to READ_SIZE bytes
+def iter_read( fh ):
+    while True:
+        data = fh.read( READ_SIZE )
+        if not data: break
+        yield data
+
+
+# decompress a gzip stream, including files of several concatenated members
+# param: file object
+# yields: decompressed strings
+def iter_gzip_chunks( fh ):
+    decomp = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+    for data in iter_read( fh ):
+        while data:
+            out = decomp.decompress( data )
+            if out:
+                yield out
+            data = decomp.unused_data
+            if data:
+                decomp = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+    out = decomp.flush()
+    if out:
+        yield out
+
+
+# split a BGZF file into its blocks, without decompressing them
+# param: file object
+# yields: raw deflate data of each block
+# throws: ValueError if a block is not valid BGZF
+def iter_bgzf_blocks( fh ):
+    while True:
+        header = fh.read( 12 )
+        if not header: break
+        if len( header ) < 12 or not header.startswith( GZIP_MAGIC ):
+            raise ValueError( "invalid BGZF block" )
+
+        xlen = struct.unpack( '<H', header[10:12] )[0]
+        extra = fh.read( xlen )
+        bsize = None
+        i = 0
+        while i + 4 <= len( extra ):
+            slen = struct.unpack( '<H', extra[i + 2:i + 4] )[0]
+            if extra[i:i + 2] == 'BC':
+                bsize = struct.unpack( '<H', extra[i + 4:i + 6] )[0]
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError( "gzip block without BGZF block size" )
+
+        # block is bsize + 1 bytes; the data ends with crc32 and size
+        rest = fh.read( bsize + 1 - 12 - xlen )
+        yield rest[:-8]
+
+
+# param: list of raw deflate strings
+# return: string, the decompressed blocks joined
+def decompress_blocks( blocks ):
+    return ''.join( zlib.decompress( block, -15 ) for block in blocks )
+
+
+# decompress a BGZF stream, batches of blocks in parallel by a pool of 
+# processes, keeping a bounded number of batches in flight and yielding 
+# them in file order. processes that are themselves pool workers can't fork 
+# a pool, they decompress serially
+# param: file object
+# param: int, number of decompressing processes
+# yields: decompressed strings
+def iter_bgzf_chunks( fh, workers ):
+    def iter_batches():
+        batch = []
+        for block in iter_bgzf_blocks( fh ):
+            batch.append( block )
+            if len( batch ) == BGZF_BATCH_BLOCKS:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        for batch in iter_batches():
+            yield decompress_blocks( batch )
+        return
+
+    pool = multiprocessing.Pool( workers )
+    try:
+        pending = collections.deque()
+        for batch in iter_batches():
+            pending.append( pool.apply_async( decompress_blocks, ( batch, ) ) )
+            if len( pending ) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# open an annotation file, transparently decompressing gzip, BGZF and zstd.
+# '-' is stdin, read blocking until end of input through a large buffer
+# param: string, file path or '-'
+# param: argparse object
+# return: file object, or file-like object with readline and close
+def open_input( filename, args ):
+    if filename == '-':
+        return os.fdopen( os.dup( sys.stdin.fileno() ), 'rb', READ_SIZE )
+
+    compression = get_compression( filename )
+    if compression is None:
+        return open( filename )
+
+    fh = open( filename, 'rb' )
+    if compression == 'gzip':
+        return IteratorFile( iter_gzip_chunks( fh ), fh.close )
+    if compression == 'bgzf':
+        return IteratorFile( iter_bgzf_chunks( fh, args.decompress_workers ), fh.close )
+
+    try:
+        import zstandard
+        # files from zstd -T or cat hold several frames, read them all
+        reader = zstandard.ZstdDecompressor().stream_reader( fh, read_across_frames=True )
+        return IteratorFile( iter_read( reader ), fh.close )
+    except ImportError:
+        fh.close()
+
+    try:
+        proc = subprocess.Popen( [ 'zstd', '-dc', filename ], stdout=subprocess.PIPE )
+    except OSError, e:
+        raise ValueError( "can't read zstd file %s: the zstandard module is not installed "
+                          "and zstd could not be run: %s" % ( filename, str( e ) ) )
+
+    # a corrupt or truncated file must fail the load, not load in part. zstd
+    # also fails when closed before the end, which is no error, so its status
+    # only counts once all its output was read
+    at_end = [ False ]
+    def iter_output():
+        for data in iter_read( proc.stdout ):
+            yield data
+        at_end[0] = True
+
+    def close():
+        proc.stdout.close()
+        returncode = proc.wait()
+        if at_end[0] and returncode != 0:
+            raise ValueError( "zstd failed to decompress %s, exit status %d" % ( filename,
+                                                                                returncode ) )
+    return IteratorFile( iter_output(), close )
+
+
+# line prefixes of headers and comments to skip
+# param: string, file path or '-'
+# param: argparse object
+# return: tuple of strings
+def get_skip_prefixes( filename, args ):
+    prefixes = []
+    if args.header_starter:
+        prefixes.append( args.header_starter )
+    if filename == '-':
+        # comment lines, as stdin has always allowed
+        prefixes.append( '#' )
+    return tuple( prefixes )
+
+
+# iterate over the snp names and values in part of a snp file, with the byte
+# offset just after each. a chunk holds every line that starts in the byte 
+# range [start, end)
+# param: string, path to snp file
+# param: argparse object
+# param: int, byte offset of start of chunk
+# param: int, byte offset of end of chunk, or None for end of file
+# yields: tuple of byte offset, list of variant name, annotation value
+def iter_file_positions( filename, args, start=0, end=None ):
+    fh = open_input( filename, args )
+    pos = start
+    if start > 0 and isinstance( fh, file ) and filename != '-':
+        # skip the line running into the chunk, it belongs to the chunk before
+        fh.seek( start - 1 )
+        pos += len( fh.readline() ) - 1
+    elif start > 0:
+        # compressed input and stdin can't seek, read up to the start instead
+        pos = 0
+        while pos < start:
+            line = fh.readline()
+            if not line: break
+            pos += len( line )
+
+    skip_prefixes = get_skip_prefixes( filename, args )
+    while end is None or pos < end:
+        line = fh.readline()
+        if not line: break
+        pos += len( line )
+        if skip_prefixes and line.startswith( skip_prefixes ): continue
+        snp2value = process_line( line, args )
+        if snp2value:
+            yield ( pos, snp2value )
+    fh.close()
+
+
+# iterate over the snp names and values in part of a snp file
+# param: string, path to snp file
+# param: argparse object
+# param: int, byte offset of start of chunk
+# param: int, byte offset of end of chunk, or None for end of file
+# yields: list of variant name, annotation value
+def iter_file_values( filename, args, start=0, end=None ):
+    for pos, snp2value in iter_file_positions( filename, args, start, end ):
+        yield snp2value
+
+
+# name of an input for messages
+# param: string, file path or '-'
+# return: string
+def get_input_name( filename ):
+    if filename == '-':
+        return 'stdin'
+    return os.path.basename( filename )
+
+
+# iterate over the snp names and values in the snp files, '-' being stdin
+# param: argparse object
+# yields: list of variant name, annotation value
+def iter_snp_values( args ):
+    for filename in args.snp_files:
+        sys.stderr.write( 'processing %s\n' % ( get_input_name( filename ) ) )
+        sys.stderr.flush()
+        for snp2value in iter_file_values( filename, args ):
+            yield snp2value
+
+
+# escape a value for COPY text format
+# param: string or None
+# return: string
+def copy_format( value ):
+    if value is None:
+        return '\\N'
+    return value.replace( '\\', '\\\\' ).replace( '\t', '\\t' ).replace( '\n', '\\n' ).replace( '\r', '\\r' )
+
+
+# name of the unlogged staging table for a load
+# param: argparse object
+# return: string
+def get_staging_table( args ):
+    return '%s_%s_staging' % ( args.table, args.features[0][1] )
+
+
+# names of the features loaded
+# param: argparse object
+# return: list of strings
+def get_feature_names( args ):
+    return [ feature for value_column, feature, datatype in args.features ]
+
+
+# (re)create the staging table, with a text column per feature
+# param: db cursor
+# param: argparse object
+# return: string, name of staging table
+def create_staging( curs, args ):
+    staging = get_staging_table( args )
+    value_columns = ', '.join( '%s varchar' % ( feature ) for feature in get_feature_names( args ) )
+    curs.execute( 'DROP TABLE IF EXISTS %s' % ( staging ) )
+    curs.execute( 'CREATE UNLOGGED TABLE %s ( seq bigint, variant_name varchar, %s )' % ( staging,
+                                                                                          value_columns ) )
+    return staging
+
+
+# stream snp names and values into the staging table with COPY. rows are 
+# numbered so that, across chunks, later input sorts after earlier input
+# param: db cursor
+# param: string, name of staging table
+# param: iterator of lists of snp name and values
+# param: argparse object
+# param: int, position of this chunk in the input
+# return: int, number of rows staged
+def copy_to_staging( curs, staging, snp_values, args, chunk_index=0 ):
+    counter = [ 0 ]
+    def copy_lines():
+        for row in snp_values:
+            counter[0] += 1
+            seq = ( chunk_index << 32 ) + counter[0]
+            yield '%d\t%s\n' % ( seq, '\t'.join( copy_format( value ) for value in row ) )
+
+    columns = ', '.join( [ 'seq', 'variant_name' ] + get_feature_names( args ) )
+    copy_sql = 'COPY %s ( %s ) FROM STDIN' % ( staging, columns )
+    curs.copy_expert( copy_sql, IteratorFile( copy_lines() ), size=1 << 20 )
+
+    return counter[0]
+
+
+# compare the staged values, the complete new contents of the columns, with
+# the current contents, and write only the differences: rows whose values 
+# were added or changed, and rows with values that are no longer in the input,
+# which are set to NULL. writes a summary of the diff to stderr. the staged 
+# rows of snp names in the table are added to the stats
+# param: db cursor
+# param: string, name of staging table
+# param: argparse object
+# param: list of FeatureStats
+# return: tuple of number of rows updated, number of unknown snp names
+def apply_staging_diff( curs, staging, args, stats ):
+    latest = '%s_latest' % ( staging )
+    latest_sql = '''CREATE TEMP TABLE {0} AS 
+                      SELECT DISTINCT ON ( variant_name ) * 
+                      FROM {1} ORDER BY variant_name, seq DESC'''.format( latest, staging )
+    curs.execute( latest_sql )
+    curs.execute( 'CREATE INDEX ON %s ( variant_name )' % ( latest ) )
+    curs.execute( 'ANALYZE %s' % ( latest ) )
+
+    features = get_feature_names( args )
+    differs = ' OR '.join( 't.{0} IS DISTINCT FROM s.{0}::{1}'.format( feature, datatype )
+                           for value_column, feature, datatype in args.features )
+    was_empty = ' AND '.join( 't.%s IS NULL' % ( feature ) for feature in features )
+    has_value = ' OR '.join( 't.%s IS NOT NULL' % ( feature ) for feature in features )
+
+    count_sql = '''SELECT COUNT(*) FILTER ( WHERE {0} ), COUNT(*) FILTER ( WHERE NOT ( {0} ) )
+                   FROM {1} t JOIN {2} s ON t.variant_name = s.variant_name
+                   WHERE {3}'''.format( was_empty, args.table, latest, differs )
+    curs.execute( count_sql )
+    n_inserted, n_changed = curs.fetchone()
+
+    set_sql = ', '.join( '{0} = s.{0}::{1}'.format( feature, datatype )
+                         for value_column, feature, datatype in args.features )
+    update_sql = '''UPDATE {0} t SET {1}
+                    FROM {2} s
+                    WHERE t.variant_name = s.variant_name AND ( {3} )'''.format( args.table, set_sql,
+                                                                                latest, differs )
+    curs.execute( update_sql )
+    n_updated = curs.rowcount
+
+    clear_sql = ', '.join( '%s = NULL' % ( feature ) for feature in features )
+    remove_sql = '''UPDATE {0} t SET {1}
+                    WHERE ( {2} ) 
+                      AND NOT EXISTS ( SELECT 1 FROM {3} s 
+                                       WHERE s.variant_name = t.variant_name )'''.format( args.table, clear_sql,
+                                                                                          has_value, latest )
+    curs.execute( remove_sql )
+    n_removed = curs.rowcount
+
+    unknown_sql = '''SELECT COUNT(*) FROM {0} s
+                     WHERE NOT EXISTS ( SELECT 1 FROM {1} t 
+                                        WHERE t.variant_name = s.variant_name )'''.format( latest, args.table )
+    curs.execute( unknown_sql )
+    n_unknown = curs.fetchone()[0]
+
+    add_applied_stats( curs, staging, args, stats )
+
+    curs.execute( 'DROP TABLE %s' % ( latest ) )
+    curs.execute( 'DROP TABLE %s' % ( staging ) )
+
+    sys.stderr.write( "diff: %d inserted, %d changed, %d removed\n" % ( n_inserted, n_changed, n_removed ) )
+
+    return ( n_updated + n_removed, n_unknown )
+
+
+# apply the staged values to the annotation table with one UPDATE ... FROM.
+# if a snp name is repeated, the last value wins, as with one UPDATE per line.
+# the staged rows of snp names in the table are added to the stats.
+# drops the staging table, or empties it for the next batch if keep is set
+# param: db cursor
+# param: string, name of staging table
+# param: argparse object
+# param: list of FeatureStats
+# param: boolean, keep the staging table
+# return: tuple of number of rows updated, number of unknown snp names
+def apply_staging( curs, staging, args, stats, keep=False ):
+    if args.differential:
+        return apply_staging_diff( curs, staging, args, stats )
+
+    curs.execute( 'ANALYZE %s' % ( staging ) )
+
+    set_sql = ', '.join( '{0} = s.{0}::{1}'.format( feature, datatype )
+                         for value_column, feature, datatype in args.features )
+    update_sql = '''UPDATE {0} t SET {1}
+                    FROM ( SELECT DISTINCT ON ( variant_name ) * 
+                           FROM {2} ORDER BY variant_name, seq DESC ) s
+                    WHERE t.variant_name = s.variant_name'''.format( args.table, set_sql, staging )
+    curs.execute( update_sql )
+    n_updated = curs.rowcount
+
+    add_applied_stats( curs, staging, args, stats )
+
+    unknown_sql = '''SELECT COUNT( DISTINCT s.variant_name ) FROM {0} s
+                     WHERE NOT EXISTS ( SELECT 1 FROM {1} t 
+                                        WHERE t.variant_name = s.variant_name )'''.format( staging, args.table )
+    curs.execute( unknown_sql )
+    n_unknown = curs.fetchone()[0]
+
+    if keep:
+        curs.execute( 'TRUNCATE %s' % ( staging ) )
+    else:
+        curs.execute( 'DROP TABLE %s' % ( staging ) )
+
+    return ( n_updated, n_unknown )
+
+
+# load snp names and values through an unlogged staging table: stream them in 
+# with COPY, then apply them with one UPDATE ... FROM
+# param: iterator of snp name, value pairs
+# param: argparse object
+# param: list of FeatureStats, the values applied are added to it
+# return: tuple of number of values loaded, number of rows updated, number of unknown snp names
+def bulk_load( snp_values, args, stats ):
+    staging = create_staging( curs, args )
+    n_values = copy_to_staging( curs, staging, snp_values, args )
+
+    sys.stderr.write( "applying %d values\n" % ( n_values ) )
+    n_updated, n_unknown = apply_staging( curs, staging, args, stats )
+
+    return ( n_values, n_updated, n_unknown )
+
+
+# split the snp files into chunks of about chunk_size bytes, at line boundaries.
+# compressed files and stdin can't be split, they are one chunk each
+# param: list of file paths
+# param: int, chunk size in bytes
+# return: list of tuples of chunk index, file path, start offset, end offset
+def get_chunks( filenames, chunk_size ):
+    chunks = []
+    for filename in filenames:
+        if filename == '-' or get_compression( filename ):
+            chunks.append( ( len( chunks ) + 1, filename, 0, None ) )
+            continue
+
+        size = os.path.getsize( filename )
+        start = 0
+        while True:
+            end = start + chunk_size
+            if end >= size: end = None
+            chunks.append( ( len( chunks ) + 1, filename, start, end ) )
+            if end is None: break
+            start = end
+
+    return chunks
+
+
+# worker process state, set up by init_worker
+WORKER_ARGS = None
+WORKER_CONN = None
+WORKER_STAGING = None
+
+# give each worker process its own db connection
+# param: argparse object
+# param: string, name of staging table
+# return: nothing
+def init_worker( args, staging ):
+    global WORKER_ARGS, WORKER_CONN, WORKER_STAGING
+    WORKER_ARGS = args
+    WORKER_STAGING = staging
+    WORKER_CONN, worker_curs = postgres_connect( args.db, args.creds_file )
+
+
+# parse one chunk of a snp file and stage it, committing so the 
+# coordinating process sees the rows
+# param: tuple of chunk index, file path, start offset, end offset
+# return: tuple of chunk index, number of rows staged
+def stage_chunk( chunk ):
+    chunk_index, filename, start, end = chunk
+    worker_curs = WORKER_CONN.cursor()
+    snp_values = iter_file_values( filename, WORKER_ARGS, start, end )
+    n_values = copy_to_staging( worker_curs, WORKER_STAGING, snp_values, WORKER_ARGS, chunk_index )
+    WORKER_CONN.commit()
+
+    return ( chunk_index, n_values )
+
+
+# load snp names and values with a pool of worker processes, each parsing 
+# and staging chunks of the snp files on its own connection. the staged rows 
+# are applied once, by the caller's connection, and committed by the caller
+# param: argparse object
+# param: list of FeatureStats, the values applied are added to it
+# return: tuple of number of values loaded, number of rows updated, number of unknown snp names
+def parallel_load( args, stats ):
+    staging = create_staging( curs, args )
+    conn.commit()
+
+    chunks = get_chunks( args.snp_files, args.chunk_size << 20 )
+    sys.stderr.write( "staging %d chunks of %d files with %d workers\n" % ( len( chunks ),
+                                                                             len( args.snp_files ),
+                                                                             args.workers ) )
+    sys.stderr.flush()
+
+    # stdin can only be read here, by the process that owns it
+    stdin_chunks = [ chunk for chunk in chunks if chunk[1] == '-' ]
+    chunks = [ chunk for chunk in chunks if chunk[1] != '-' ]
+
+    pool = multiprocessing.Pool( args.workers, init_worker, ( args, staging ) )
+    try:
+        results = pool.imap_unordered( stage_chunk, chunks )
+
+        n_values = 0
+        for chunk_index, filename, start, end in stdin_chunks:
+            snp_values = iter_file_values( filename, args )
+            n_values += copy_to_staging( curs, staging, snp_values, args, chunk_index )
+
+        n_done = 0
+        for chunk_index, n_chunk in results:
+            n_values += n_chunk
+            n_done += 1
+            if args.debug:
+                sys.stderr.write( "staged chunk %d/%d\n" % ( n_done, len( chunks ) ) )
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    sys.stderr.write( "applying %d values\n" % ( n_values ) )
+    n_updated, n_unknown = apply_staging( curs, staging, args, stats )
+
+    return ( n_values, n_updated, n_unknown )
+
+
+# read the progress journal of an earlier load
+# param: string, path to journal file
+# return: dict of load state, or None if there is no journal
+def read_journal( journal_file ):
+    if not os.path.exists( journal_file ):
+        return None
+    fh = open( journal_file )
+    state = json.load( fh )
+    fh.close()
+    return state
+
+
+# write the progress journal; written to a temp file and renamed so that a 
+# load killed mid-write leaves the previous checkpoint intact
+# param: string, path to journal file
+# param: dict of load state
+# return: nothing
+def write_journal( journal_file, state ):
+    tmp_file = '%s.%d.tmp' % ( journal_file, os.getpid() )
+    fh = open( tmp_file, 'w' )
+    json.dump( state, fh )
+    fh.close()
+    os.rename( tmp_file, journal_file )
+
+
+# list of the inputs of a load, as recorded in the journal; '-' is stdin
+# param: argparse object
+# return: list of strings
+def get_sources( args ):
+    return [ filename if filename == '-' else os.path.abspath( filename ) for filename in args.snp_files ]
+
+
+# iterate over the values of every input, with the position to resume from 
+# after each value: the byte offset in the input, decompressed if need be.
+# resuming stdin reads past the offset, so the same input has to be piped in
+# param: argparse object
+# param: int, index of input to start at
+# param: int, position in that input to start at
+# yields: tuple of input index, position after value, list of variant name and values
+def iter_positioned_values( args, source_index=0, position=0 ):
+    for i, filename in enumerate( args.snp_files ):
+        if i < source_index: continue
+        start = 0
+        if i == source_index:
+            start = position
+
+        sys.stderr.write( 'processing %s\n' % ( get_input_name( filename ) ) )
+        sys.stderr.flush()
+        for pos, snp2value in iter_file_positions( filename, args, start ):
+            yield ( i, pos, snp2value )
+
+
+# load snp names and values committing every args.commit_every values, and,
+# with args.journal, recording after each commit the input and position 
+# reached, so an interrupted load can be resumed where it stopped
+# param: argparse object
+# param: list of FeatureStats, the values applied are added to it; restored from the journal on resume
+# param: string, per line update statement
+# param: dict of load state from the journal to resume from, or None
+# return: tuple of number of values loaded, number of rows updated, number of unknown snp names
+# throws: ValueError if the journal is for a different load
+def checkpointed_load( args, stats, update_sql, state=None ):
+    if state:
+        if state['table'] != args.table or state['columns'] != get_feature_names( args ) or \
+           state['sources'] != get_sources( args ):
+            raise ValueError( "journal %s is for a different load" % ( args.journal ) )
+        for feature_stats, feature_state in zip( stats, state['stats'] ):
+            feature_stats.__dict__.update( feature_state )
+        if state['done']:
+            sys.stderr.write( "journal %s: load already complete\n" % ( args.journal ) )
+            return ( state['n_values'], state['n_updated'], state['n_unknown'] )
+        sys.stderr.write( "resuming after %d values\n" % ( state['n_values'] ) )
+    else:
+        state = { 'table': args.table, 'columns': get_feature_names( args ), 'sources': get_sources( args ),
+                  'source_index': 0, 'position': 0, 'n_values': 0, 'n_updated': 0, 'n_unknown': 0,
+                  'done': False }
+
+    staging = None
+    if args.bulk:
+        staging = create_staging( curs, args )
+
+    # commits the rows since the last checkpoint and moves the checkpoint to 
+    # just after the last value applied
+    def checkpoint( batch, source_index, position ):
+        if staging:
+            copy_to_staging( curs, staging, iter( batch ), args )
+            n_updated, n_unknown = apply_staging( curs, staging, args, stats, keep=True )
+            state['n_updated'] += n_updated
+            state['n_unknown'] += n_unknown
+        conn.commit()
+
+        state['source_index'], state['position'] = source_index, position
+        state['stats'] = [ feature_stats.__dict__ for feature_stats in stats ]
+        if args.journal:
+            write_journal( args.journal, state )
+        if args.debug:
+            sys.stderr.write( "committed %d values\n" % ( state['n_values'] ) )
+
+    batch = []
+    source_index, position = state['source_index'], state['position']
+    for source_index, position, row in iter_positioned_values( args, source_index, position ):
+        if staging:
+            batch.append( row )
+        else:
+            curs.execute( update_sql, row[1:] + row[:1] )
+            if curs.rowcount:
+                state['n_updated'] += curs.rowcount
+                add_stats( stats, row[1:] )
+            else:
+                state['n_unknown'] += 1
+        state['n_values'] += 1
+
+        if state['n_values'] % args.commit_every == 0:
+            checkpoint( batch, source_index, position )
+            batch = []
+
+    state['done'] = True
+    checkpoint( batch, source_index, position )
+    if staging:
+        curs.execute( 'DROP TABLE %s' % ( staging ) )
+
+    return ( state['n_values'], state['n_updated'], state['n_unknown'] )
+
+
+# find the indexes on the annotation columns, other than those backing a 
+# primary key or unique constraint
+# param: argparse object
+# return: list of tuples of index name, index definition
+def get_column_indexes( args ):
+    sql = '''SELECT DISTINCT i.relname, pg_get_indexdef( ix.indexrelid )
+             FROM pg_index ix
+               JOIN pg_class i ON i.oid = ix.indexrelid
+               JOIN pg_class t ON t.oid = ix.indrelid
+               JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY( ix.indkey )
+             WHERE t.relname = %s AND a.attname = ANY( %s )
+               AND NOT ix.indisprimary
+               AND NOT EXISTS ( SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid )
+             ORDER BY i.relname'''
+    curs.execute( sql, [ args.table, get_feature_names( args ) ] )
+    return [ tuple( row ) for row in curs.fetchall() ]
+
+
+# file the definitions of deferred indexes are saved to: next to the journal,
+# or in the working directory
+# param: argparse object
+# return: string
+def get_index_file( args ):
+    if args.journal:
+        return args.journal + '.indexes'
+    return '%s.%s.indexes' % ( args.db, args.table )
+
+
+# drop the indexes on the annotation columns before a load, so they are built
+# once afterwards instead of maintained row by row. the definitions are always
+# saved to the index file first, so they can't be lost if the load dies
 # param: argparse object
+# return: list of index definitions
+def defer_indexes( args ):
+    index_file = get_index_file( args )
+
+    index_defs = []
+    if args.resume and os.path.exists( index_file ):
+        fh = open( index_file )
+        index_defs = json.load( fh )
+        fh.close()
+
+    # on resume, indexes rebuilt after the failed run are dropped again
+    indexes = get_column_indexes( args )
+    for index_name, index_def in indexes:
+        if index_def not in index_defs:
+            index_defs.append( index_def )
+    write_journal( index_file, index_defs )
+    sys.stderr.write( "index definitions saved to %s\n" % ( index_file ) )
+
+    for index_name, index_def in indexes:
+        sys.stderr.write( "dropping index %s: %s\n" % ( index_name, index_def ) )
+        curs.execute( 'DROP INDEX %s' % ( index_name ) )
+    conn.commit()
+
+    return index_defs
+
+
+# build indexes without locking out readers, with more memory for the sort
+# param: list of CREATE INDEX statements
+# param: argparse object
+# return: nothing
+def build_indexes( index_defs, args ):
+    if not index_defs: return
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    conn.commit()
+    conn.autocommit = True
+    try:
+        curs.execute( 'SET maintenance_work_mem = %s', [ args.maintenance_work_mem ] )
+        for index_def in index_defs:
+            index_def = re.sub( r'^(CREATE (?:UNIQUE )?INDEX) ', r'\1 CONCURRENTLY ', index_def,
+                                flags=re.IGNORECASE )
+            sys.stderr.write( "%s\n" % ( index_def ) )
+            sys.stderr.flush()
+            curs.execute( index_def )
+        curs.execute( 'RESET maintenance_work_mem' )
+    finally:
+        conn.autocommit = False
+
+
+# datatypes whose values are summarized numerically
+NUMERIC_DATATYPES = [ 'float', 'real', 'double precision', 'numeric', 'decimal',
+                      'integer', 'int', 'smallint', 'bigint' ]
+# size of the reservoir sample the quantiles are taken from
+RESERVOIR_SIZE = 10000
+QUANTILES = [ 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99 ]
+
+
+# check if a datatype is summarized numerically
+# param: string, SQL datatype
+# return: boolean
+def is_numeric_datatype( datatype ):
+    datatype = datatype.lower()
+    for numeric in NUMERIC_DATATYPES:
+        if datatype == numeric or datatype.startswith( numeric + '(' ):
+            return True
+    return False
+
+
+# summary statistics of a feature, gathered while the values stream in, in 
+# constant memory: count, null count, min, max, mean, and quantiles from a
+# reservoir sample
+class FeatureStats( object ):
+    def __init__( self, datatype ):
+        self.numeric = is_numeric_datatype( datatype )
+        self.count = 0
+        self.nulls = 0
+        self.n_numbers = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.sample = []
+
+    # param: string value, or None
+    # return: nothing
+    # throws: ValueError if a value of a numeric feature is not a number
+    def add( self, value ):
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        if not self.numeric:
+            return
+
+        try:
+            x = float( value )
+        except ValueError:
+            raise ValueError( "value %s is not a number" % ( value ) )
+
+        self.n_numbers += 1
+        self.total += x
+        if self.min is None or x < self.min: self.min = x
+        if self.max is None or x > self.max: self.max = x
+
+        if len( self.sample ) < RESERVOIR_SIZE:
+            self.sample.append( x )
+        else:
+            i = random.randrange( self.n_numbers )
+            if i < RESERVOIR_SIZE:
+                self.sample[i] = x
+
+    # fold in the stats of values summarized elsewhere, eg by an aggregate in the db
+    # param: int, number of values
+    # param: int, number of nulls
+    # param: int, number of numeric values
+    # param: float, sum of the numeric values
+    # param: float, smallest numeric value, or None
+    # param: float, largest numeric value, or None
+    # param: list of floats, uniform sample of the numeric values
+    # return: nothing
+    def add_aggregate( self, count, nulls, n_numbers, total, x_min, x_max, sample ):
+        n_self = self.n_numbers
+        self.count += count
+        self.nulls += nulls
+        self.n_numbers += n_numbers
+        self.total += total
+        for x in [ x_min, x_max ]:
+            if x is None: continue
+            if self.min is None or x < self.min: self.min = x
+            if self.max is None or x > self.max: self.max = x
+
+        # draw the merged reservoir from each side in proportion to the 
+        # number of values that side saw
+        mine, theirs = list( self.sample ), list( sample )
+        random.shuffle( mine )
+        random.shuffle( theirs )
+        merged = []
+        while len( merged ) < RESERVOIR_SIZE and ( mine or theirs ):
+            if theirs and ( not mine or random.random() * ( n_self + n_numbers ) >= n_self ):
+                merged.append( theirs.pop() )
+            else:
+                merged.append( mine.pop() )
+        self.sample = merged
+
+    # return: mean of the numeric values, or None
+    def mean( self ):
+        if not self.n_numbers: return None
+        return self.total / self.n_numbers
+
+    # param: list of floats in [0, 1]
+    # return: dict of quantile to estimated value
+    def quantiles( self, qs ):
+        sample = sorted( self.sample )
+        if not sample: return {}
+
+        q2value = {}
+        for q in qs:
+            # linear interpolation between closest ranks
+            pos = q * ( len( sample ) - 1 )
+            lo = int( pos )
+            hi = min( lo + 1, len( sample ) - 1 )
+            q2value[q] = sample[lo] + ( sample[hi] - sample[lo] ) * ( pos - lo )
+        return q2value
+
+
+# one FeatureStats per feature loaded
+# param: argparse object
+# return: list of FeatureStats
+def get_feature_stats( args ):
+    return [ FeatureStats( datatype ) for value_column, feature, datatype in args.features ]
+
+
+# add the values of one row applied to the table to the stats
+# param: list of FeatureStats
+# param: list of values, one per feature
+# return: nothing
+def add_stats( stats, values ):
+    for feature_stats, value in zip( stats, values ):
+        feature_stats.add( value )
+
+
+# add the staged rows that were applied, those of snp names in the annotation
+# table, to the stats with one aggregate query in the db. every applied row 
+# counts, as in the per line path, where a repeated snp name is counted each
+# time its UPDATE is applied. for the quantiles the query returns a uniform
+# sample of about RESERVOIR_SIZE of the values, which is merged into the 
+# reservoir, so the stats of checkpoint batches combine like those of lines
+# param: db cursor
+# param: string, name of staging table
+# param: argparse object
+# param: list of FeatureStats
+# return: nothing
+def add_applied_stats( curs, staging, args, stats ):
+    aggregates = [ 'COUNT(*)' ]
+    for ( value_column, feature, datatype ), feature_stats in zip( args.features, stats ):
+        aggregates.append( 'COUNT(*) FILTER ( WHERE s.{0} IS NULL )'.format( feature ) )
+        if feature_stats.numeric:
+            x = 's.{0}::double precision'.format( feature )
+            sample = ( 'ARRAY_AGG( {0} ) FILTER ( WHERE s.{1} IS NOT NULL AND '
+                       'RANDOM() * ( SELECT COUNT(*) FROM {2} ) < {3} )' ).format( x, feature, staging,
+                                                                                   RESERVOIR_SIZE )
+            aggregates.extend( [ 'COUNT( %s )' % ( x ), 'SUM( %s )' % ( x ), 'MIN( %s )' % ( x ), 
+                                 'MAX( %s )' % ( x ), sample ] )
+
+    applied_sql = '''SELECT {0} FROM {1} s
+                     WHERE EXISTS ( SELECT 1 FROM {2} t 
+                                    WHERE t.variant_name = s.variant_name )'''.format( ', '.join( aggregates ),
+                                                                                        staging, args.table )
+    curs.execute( applied_sql )
+    row = list( curs.fetchone() )
+
+    count = row.pop( 0 )
+    for feature_stats in stats:
+        nulls = row.pop( 0 )
+        n_numbers, total, x_min, x_max, sample = 0, 0.0, None, None, None
+        if feature_stats.numeric:
+            n_numbers, total, x_min, x_max, sample = row[:5]
+            del row[:5]
+        feature_stats.add_aggregate( count, nulls, n_numbers, total or 0.0, x_min, x_max, sample or [] )
+
+
+# stats columns of the summary table, added by add_summary_columns
+SUMMARY_STATS_COLUMNS = [ ( 'feature_null_count', 'bigint' ), ( 'feature_mean', 'double precision' ),
+                          ( 'feature_quantiles', 'varchar' ) ]
+
+# one-time migration of a summary table made before the stats columns 
+# existed. runs before the load, so a table that can't be altered fails the 
+# run up front, and alters the table only when a column is missing
+# param: argparse object
+# return: nothing
+def add_summary_columns( args ):
+    sql = """SELECT column_name
+             FROM information_schema.columns 
+             WHERE table_name='{0}'""".format( args.summary_table )
+    curs.execute( sql )
+    columns = set( row[0] for row in curs.fetchall() )
+    missing = [ ( column, datatype ) for column, datatype in SUMMARY_STATS_COLUMNS if column not in columns ]
+    if not missing:
+        return
+
+    add_sql = ', '.join( 'ADD COLUMN IF NOT EXISTS %s %s' % ( column, datatype ) for column, datatype in missing )
+    curs.execute( 'ALTER TABLE {0} {1}'.format( args.summary_table, add_sql ) )
+    conn.commit()
+
+
+# for summary table, get range of values in annotation
+# param: string, feature datatype
+# param: FeatureStats of the loaded values
 # return: string representing range
-def get_range( args ):
-    if args.db_column_datatype == 'boolean':
+def get_range( datatype, stats ):
+    if datatype == 'boolean':
         f_range = 'True, False'
-    elif args.db_column_datatype == 'varchar':
+    elif datatype in [ 'varchar', 'string' ]:
         f_range = 'NA'
-    elif args.db_column_datatype == 'float' or args.db_column_datatype == 'integer':
-
-        sql = 'SELECT MAX( %s ), MIN( %s ) FROM %s' % ( args.db_column_name,
-                                                        args.db_column_name,
-                                                        args.table )
-        curs.execute( sql )
-        col_max, col_min = curs.fetchone()
-        f_range = '%s, $s' % ( col_min, col_max )
+    elif stats.numeric:
+        if stats.min is None:
+            f_range = 'NA'
+        elif datatype.lower() in [ 'integer', 'int', 'smallint', 'bigint' ]:
+            f_range = '%d, %d' % ( stats.min, stats.max )
+        else:
+            f_range = '%s, %s' % ( stats.min, stats.max )
     else:
-        msg = "Can't determine feature range for datatype %s\n" % ( args.db_column_datatype )
+        msg = "Can't determine feature range for datatype %s\n" % ( datatype )
         raise ValueError( msg )
 
 
     return f_range
 
 
+# lines read per block in a dry run
+DRY_RUN_BLOCK_SIZE = 8 << 20
+# postgres input literals for boolean
+BOOLEAN_VALUES = set( [ 't', 'true', 'y', 'yes', 'on', '1', 'f', 'false', 'n', 'no', 'off', '0' ] )
+INTEGER_RANGES = { 'smallint': ( -2**15, 2**15 ), 'integer': ( -2**31, 2**31 ), 'int': ( -2**31, 2**31 ),
+                   'bigint': ( -2**63, 2**63 ) }
+
+
+# check one value against a datatype, for the slow path of find_bad_values
+# param: string value
+# param: string, SQL datatype
+# return: nothing
+# throws: ValueError if the value is not valid for the datatype
+def check_value( value, datatype ):
+    datatype = datatype.lower()
+    if datatype in INTEGER_RANGES:
+        low, high = INTEGER_RANGES[datatype]
+        if not low <= int( value ) < high:
+            raise ValueError( "out of range for %s" % ( datatype ) )
+    elif is_numeric_datatype( datatype ):
+        float( value )
+    elif datatype == 'boolean':
+        if value.strip().lower() not in BOOLEAN_VALUES:
+            raise ValueError( "not a boolean" )
+    else:
+        mo = re.match( r'(?:var)?char\((\d+)\)$', datatype.replace( ' ', '' ) )
+        if mo and len( value ) > int( mo.group( 1 ) ):
+            raise ValueError( "longer than %s" % ( mo.group( 1 ) ) )
+
+
+# type check a whole column of a block at once. the common case, a valid 
+# column, is decided by one conversion over the column in C; only a column 
+# with a bad value is walked value by value to find it
+# param: list of string values, None for null
+# param: string, SQL datatype
+# return: list of tuples of index in column, error message
+def find_bad_values( values, datatype ):
+    dtype = datatype.lower()
+    present = values
+    if None in values:
+        present = [ value for value in values if value is not None ]
+    try:
+        if dtype in INTEGER_RANGES:
+            numbers = map( int, present )
+            low, high = INTEGER_RANGES[dtype]
+            if numbers and ( min( numbers ) < low or max( numbers ) >= high ):
+                raise ValueError
+        elif is_numeric_datatype( dtype ):
+            map( float, present )
+        elif dtype == 'boolean':
+            if set( map( str.lower, map( str.strip, present ) ) ) - BOOLEAN_VALUES:
+                raise ValueError
+        else:
+            mo = re.match( r'(?:var)?char\((\d+)\)$', dtype.replace( ' ', '' ) )
+            if mo and present and max( map( len, present ) ) > int( mo.group( 1 ) ):
+                raise ValueError
+        return []
+    except ValueError:
+        pass
+
+    bad = []
+    for i, value in enumerate( values ):
+        if value is None: continue
+        try:
+            check_value( value, datatype )
+        except ValueError, e:
+            bad.append( ( i, "%s: %s" % ( value, str( e ) ) ) )
+    return bad
+
+
+# iterate over the input in blocks of lines
+# param: argparse object
+# yields: tuple of file path or '-', line number of first line, list of lines
+def iter_line_blocks( args ):
+    for filename in args.snp_files:
+        fh = open_input( filename, args )
+        line_no = 1
+        while True:
+            lines = fh.readlines( DRY_RUN_BLOCK_SIZE )
+            if not lines: break
+            yield ( filename, line_no, lines )
+            line_no += len( lines )
+        fh.close()
+
+
+# split a block of lines into columns. when every line is data with the same
+# number of fields, which is the usual case, the block is split in one go and
+# the columns sliced out; otherwise line by line. comment and header lines are
+# found by searching the joined block rather than testing every line
+# param: list of lines
+# param: argparse object
+# param: tuple of prefixes of lines to skip
+# return: tuple of list of line indexes, function of column index to list of values or None
+def split_block( lines, args, skip_prefixes ):
+    stripped = map( str.strip, lines )
+    text = '\n'.join( stripped )
+    counts = map( str.count, stripped, [ args.delim ] * len( stripped ) )
+    if counts and min( counts ) == max( counts ) and '' not in stripped and \
+       not any( ( '\n' + prefix ) in ( '\n' + text ) for prefix in skip_prefixes or () ):
+        n_fields = counts[0] + 1
+        fields = text.replace( '\n', args.delim ).split( args.delim )
+        def get_column( column ):
+            if column >= n_fields:
+                return [ None ] * len( lines )
+            return fields[column::n_fields]
+        return ( range( len( lines ) ), get_column )
+
+    indexes, rows = [], []
+    for i, line in enumerate( stripped ):
+        if not line: continue
+        if skip_prefixes and line.startswith( skip_prefixes ): continue
+        indexes.append( i )
+        rows.append( line.split( args.delim ) )
+    def get_column( column ):
+        return [ row[column] if len( row ) > column else None for row in rows ]
+    return ( indexes, get_column )
+
+
+# parse and type check a block of lines
+# param: list of lines
+# param: argparse object
+# param: tuple of prefixes of lines to skip
+# return: tuple of list of variant names, list of tuples of index in block, error message
+def validate_block( lines, args, skip_prefixes ):
+    indexes, get_column = split_block( lines, args, skip_prefixes )
+
+    bad = {}
+    names = get_column( args.snp_name_column )
+    if None in names:
+        for i, snp_name in zip( indexes, names ):
+            if snp_name is None:
+                bad[i] = "no variant name in column %d" % ( args.snp_name_column + 1 )
+        names = [ snp_name for snp_name in names if snp_name is not None ]
+
+    for value_column, feature, datatype in args.features:
+        if datatype.lower() == 'boolean' and not args.feature_map:
+            # the value is --present_snp_value, not read from the line
+            continue
+        values = get_column( value_column )
+        if args.default_value is not None and None in values:
+            values = [ args.default_value if value is None else value for value in values ]
+        for j, msg in find_bad_values( values, datatype ):
+            bad.setdefault( indexes[j], "%s %s" % ( feature, msg ) )
+
+    return ( names, sorted( bad.items() ) )
+
+
+# validate one block in a worker process. the block travels as one string,
+# which is much cheaper to pass between processes than a list of lines
+# param: string, lines of the block
+# param: tuple of prefixes of lines to skip
+# return: tuple of variant names in COPY format, list of tuples of index in block, error message
+def validate_text( text, skip_prefixes ):
+    names, bad = validate_block( text.splitlines( True ), WORKER_ARGS, skip_prefixes )
+    return ( get_copy_names( names ), bad )
+
+
+def init_validate_worker( args ):
+    global WORKER_ARGS
+    WORKER_ARGS = args
+
+
+# variant names as a block of COPY input
+# param: list of variant names
+# return: string
+def get_copy_names( names ):
+    if not names:
+        return ''
+    block = '\n'.join( names )
+    # names rarely need escaping for COPY
+    if '\\' in block or '\t' in block or '\r' in block:
+        block = '\n'.join( copy_format( snp_name ) for snp_name in names )
+    return block + '\n'
+
+
+# validate the input block by block, in order; with --workers, blocks are
+# validated by a pool with a bounded number in flight
+# param: argparse object
+# yields: tuple of file path or '-', line number of first line, number of lines,
+#         variant names in COPY format, list of tuples of index in block, error message
+def iter_validated_blocks( args ):
+    if args.workers <= 1:
+        for filename, first_line, lines in iter_line_blocks( args ):
+            names, bad = validate_block( lines, args, get_skip_prefixes( filename, args ) )
+            yield ( filename, first_line, len( lines ), get_copy_names( names ), bad )
+        return
+
+    pool = multiprocessing.Pool( args.workers, init_validate_worker, ( args, ) )
+    try:
+        pending = collections.deque()
+        for filename, first_line, lines in iter_line_blocks( args ):
+            result = pool.apply_async( validate_text, ( ''.join( lines ),
+                                                        get_skip_prefixes( filename, args ) ) )
+            pending.append( ( filename, first_line, len( lines ), result ) )
+            if len( pending ) >= 2 * args.workers:
+                filename, first_line, n_lines, result = pending.popleft()
+                yield ( filename, first_line, n_lines ) + result.get()
+        while pending:
+            filename, first_line, n_lines, result = pending.popleft()
+            yield ( filename, first_line, n_lines ) + result.get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# read and validate the input without writing to the annotation table: 
+# bad lines, duplicate variant names, and variant names not in the table. 
+# the names go to a temporary table, so the duplicate and unknown checks 
+# are done by the db rather than in memory
+# param: argparse object
+# return: int, number of problems found
+def dry_run( args ):
+    if 'boolean' in [ datatype.lower() for value_column, feature, datatype in args.features ] and \
+       not args.feature_map and not args.present_snp_value:
+        sys.stderr.write( "specify --present_snp_value\n" )
+        return 1
+
+    curs.execute( 'CREATE TEMP TABLE dry_run_names ( variant_name varchar )' )
+
+    counts = { 'lines': 0, 'bad': 0 }
+    def iter_names():
+        for filename, first_line, n_lines, block, bad in iter_validated_blocks( args ):
+            counts['lines'] += n_lines
+            for i, msg in bad:
+                counts['bad'] += 1
+                if counts['bad'] <= args.max_report:
+                    sys.stdout.write( "bad line\t%s:%d\t%s\n" % ( get_input_name( filename ), 
+                                                                      first_line + i, msg ) )
+            if block:
+                yield block
+
+    curs.copy_expert( 'COPY dry_run_names FROM STDIN', IteratorFile( iter_names() ), size=1 << 20 )
+    curs.execute( 'ANALYZE dry_run_names' )
+
+    sql = '''SELECT variant_name, COUNT(*) FROM dry_run_names 
+             GROUP BY variant_name HAVING COUNT(*) > 1'''
+    curs.execute( sql )
+    n_duplicate = 0
+    for snp_name, n in curs:
+        n_duplicate += 1
+        if n_duplicate <= args.max_report:
+            sys.stdout.write( "duplicate\t%s\t%d\n" % ( snp_name, n ) )
+
+    sql = '''SELECT DISTINCT s.variant_name FROM dry_run_names s
+             WHERE NOT EXISTS ( SELECT 1 FROM {0} t 
+                                WHERE t.variant_name = s.variant_name )'''.format( args.table )
+    curs.execute( sql )
+    n_unknown = 0
+    for row in curs:
+        n_unknown += 1
+        if n_unknown <= args.max_report:
+            sys.stdout.write( "unknown\t%s\n" % ( row[0] ) )
+
+    conn.rollback()
+
+    sys.stderr.write( "%d lines: %d bad lines, %d duplicate variant names, %d unknown variant names\n" % 
+                      ( counts['lines'], counts['bad'], n_duplicate, n_unknown ) )
+
+    return counts['bad'] + n_duplicate + n_unknown
+
+
 def parse_args():
     parser = argparse.ArgumentParser( description='''Add to or update snp annotations in a db table.''' )
 
+    parser.add_argument( '--bulk', action='store_true',
+                         help='''load through an unlogged staging table with COPY and one set-based 
+                                 UPDATE, instead of one UPDATE per line''' )
+    parser.add_argument( '--chunk_size', type=int, default=256,
+                         help='with --workers, size in MB of the file chunks handed to workers; default: 256' )
+    parser.add_argument( '--commit_every', type=int,
+                         help='''commit after every this many values instead of once at the end;
+                                 default: 100000 with --journal, otherwise off''' )
     parser.add_argument( '--create_column', action='store_true', 
                          help='drop, create column; DELETES EXISTING DATA IN COLUMN' )
     parser.add_argument( '--create_index', action='store_true', help='add index on annotation column' )
@@ -118,17 +1417,46 @@ def parse_args():
                          help='''file with db credentials; tab-separated user, password, port, and host
                                  default: /home/cconnoll/chuckworking/annotation_db/gecco_db_creds''',
                          default='/home/cconnoll/chuckworking/annotation_db/gecco_db_creds' )
+    parser.add_argument( '--debug', action='store_true' )
+    parser.add_argument( '--decompress_workers', type=int, default=4,
+                         help='processes decompressing BGZF input in parallel; default: 4' )
+    parser.add_argument( '--defer_indexes', action='store_true',
+                         help='''drop the indexes on the column during the load and rebuild them
+                                 afterwards with CREATE INDEX CONCURRENTLY. the definitions are
+                                 saved to <journal>.indexes, or <db>.<table>.indexes without
+                                 --journal, until the indexes are rebuilt. a failed load rebuilds
+                                 them before exiting, except with --journal, where --resume does''' )
     parser.add_argument( '--default_value', default=None, help='default: None; used for missing values' )
     parser.add_argument( '--delim', default='\t', help='field delimiter, defaults to tab' )
+    parser.add_argument( '--dry_run', action='store_true',
+                         help='''only validate the input: report bad lines, duplicate variant names and 
+                                 variant names not in the table, without writing to it''' )
+    parser.add_argument( '--differential', action='store_true',
+                         help='''treat the input as the complete new contents of the columns and write
+                                 only the rows that were inserted, changed or removed; implies --bulk.
+                                 with --create_column, an existing column is kept''' )
     parser.add_argument( '--db', help="name of db; defaults to 'functional_annotation'",
                          default='functional_annotation' )
-    parser.add_argument( '--db_column_name', required=True, help='name of feature' )
-    parser.add_argument( '--db_column_datatype', required=True,
+    parser.add_argument( '--db_column_name', help='name of feature' )
+    parser.add_argument( '--db_column_datatype',
                          help='valid SQL datatype, needed if creating column here' )
+    parser.add_argument( '--feature_map', nargs='*',
+                         help='''load several features from one pass over the input, each given as
+                                 column:feature:datatype, eg 5:cadd_phred:float. replaces 
+                                 --db_column_name, --db_column_datatype and --value_column''' )
     parser.add_argument( '--header_starter', help='start of header line if present' )
+    parser.add_argument( '--journal',
+                         help='progress journal, updated with the input file and byte offset at each commit' )
+    parser.add_argument( '--max_report', type=int, default=100,
+                         help='with --dry_run, number of each kind of problem listed; default: 100' )
+    parser.add_argument( '--maintenance_work_mem', default='1GB',
+                         help='maintenance_work_mem for building indexes; default: 1GB' )
     parser.add_argument( '-p', '--present_snp_value', help='value to insert if snp is present in list' ) 
+    parser.add_argument( '--resume', action='store_true',
+                         help='continue an interrupted load from the last checkpoint in --journal' )
     parser.add_argument( '--snp_files', nargs='*',
-                         help='file with snp names and optionally value' )
+                         help='''file with snp names and optionally value; may be gzip, bgzip or zstd 
+                                 compressed. '-' or 'stdin' reads stdin, as does giving no files''' )
     parser.add_argument( '--snp_name_column', type=int, default=1,
                          help='column in snp_file with snp_name; defaults to 1')
     parser.add_argument( '--summary_table', 
@@ -140,13 +1468,47 @@ def parse_args():
                          help="update column, requires that column exists already" )
     parser.add_argument( '--value_column', type=int, default=2,
                          help='column in snp_file with value; defaults to 2' )
+    parser.add_argument( '--workers', type=int, default=1,
+                         help='''number of processes parsing and staging the snp files, each with its
+                                 own db connection; more than 1 implies --bulk. with --dry_run,
+                                 number of processes validating the input. default: 1''' )
     
     args = parser.parse_args()
 
-    for arg in [ args.db, args.db_column_name, args.db_column_datatype, args.table ]:
+    # list of value column, feature name, datatype
+    args.features = []
+    if args.feature_map:
+        for mapping in args.feature_map:
+            try:
+                value_column, feature, datatype = mapping.split( ':', 2 )
+                args.features.append( ( int( value_column ) - 1, feature, datatype ) )
+            except ValueError:
+                parser.error( "can't parse feature map %s, expected column:feature:datatype" % ( mapping ) )
+    elif args.db_column_name and args.db_column_datatype:
+        args.features.append( ( args.value_column - 1, args.db_column_name, args.db_column_datatype ) )
+    else:
+        parser.error( 'specify --db_column_name and --db_column_datatype, or --feature_map' )
+
+    for arg in [ args.db, args.table ]:
         sanitize( arg )
+    for value_column, feature, datatype in args.features:
+        sanitize( feature )
+        sanitize( datatype )
+
+    if args.resume and not args.journal:
+        parser.error( '--resume requires --journal' )
+    if args.journal and not args.commit_every:
+        args.commit_every = 100000
+    if args.commit_every and args.workers > 1:
+        parser.error( '--commit_every and --journal can not be used with --workers' )
+    if args.differential:
+        if args.commit_every:
+            parser.error( '--differential needs the whole input at once, it can not be used with --commit_every' )
+        args.bulk = True
 
 
+    args.snp_files = [ '-' if filename == 'stdin' else filename for filename in args.snp_files or [ '-' ] ]
+
     args.snp_name_column -= 1
     args.value_column -= 1
     return args
@@ -177,81 +1539,131 @@ if __name__ == '__main__':
 
     conn, curs = postgres_connect( args.db, args.creds_file )
 
-    if args.create_column:
-        drop_column_sql = '''ALTER TABLE {0} DROP COLUMN IF EXISTS {1}'''.format( args.table, args.db_column_name )
-        curs.execute( drop_column_sql )
-        conn.commit()
+    if args.dry_run:
+        if dry_run( args ):
+            sys.exit( 1 )
+        sys.exit( 0 )
 
-        add_column_sql = '''ALTER TABLE {0} ADD COLUMN {1} {2}'''.format( args.table, 
-                                                                          args.db_column_name, 
-                                                                          args.db_column_datatype )
-        curs.execute( add_column_sql )
-        conn.commit()
-    elif args.update_column:
-        sql = """SELECT column_name
-                 FROM information_schema.columns 
-                 WHERE table_name='{0}' and column_name='{1}'""".format( args.table, args.db_column_name )
-        curs.execute( sql )
-        row = curs.fetchone()
-        if not row:
-            sys.stderr.write( "column %s does not exist in table %s\n" % ( args.db_column_name, 
-                                                                           args.table ) )
-            sys.exit()
-    else:
+    state = None
+    if args.resume:
+        state = read_journal( args.journal )
+
+    if not ( args.create_column or args.update_column ):
         sys.stderr.write( "please specify '--update_column' or '--create_column'\n" )
         sys.exit()
 
-    update_sql = 'UPDATE {0} SET {1} = %s WHERE variant_name = %s'.format( args.table, 
-                                                                           args.db_column_name )
+    for value_column, feature, datatype in args.features:
+        # a differential load compares against the current column
+        if args.create_column and args.differential:
+            add_column_sql = '''ALTER TABLE {0} ADD COLUMN IF NOT EXISTS {1} {2}'''.format( args.table, 
+                                                                                            feature, datatype )
+            curs.execute( add_column_sql )
+            conn.commit()
+        # a resumed load keeps the column it already filled in part
+        elif args.create_column and not state:
+            drop_column_sql = '''ALTER TABLE {0} DROP COLUMN IF EXISTS {1}'''.format( args.table, feature )
+            curs.execute( drop_column_sql )
+            conn.commit()
 
-    # read snps from stdin
-    while sys.stdin in select.select([sys.stdin,],[],[],0.0)[0]:
-        line = sys.stdin.readline()
-        if line.startswith( '#' ): continue
-        if line:
-            snp_name, value = process_line( line, args )
-            curs.execute( update_sql, [ value, snp_name] )
-        
-    # read snps from files
-    values = []
-    for filename in args.snp_files:
+            add_column_sql = '''ALTER TABLE {0} ADD COLUMN {1} {2}'''.format( args.table, feature, datatype )
+            curs.execute( add_column_sql )
+            conn.commit()
+        else:
+            sql = """SELECT column_name
+                     FROM information_schema.columns 
+                     WHERE table_name='{0}' and column_name='{1}'""".format( args.table, feature )
+            curs.execute( sql )
+            row = curs.fetchone()
+            if not row:
+                sys.stderr.write( "column %s does not exist in table %s\n" % ( feature, args.table ) )
+                sys.exit()
 
-        # might be nice to fork and sbatch here, committing at the end, 
-        # would need to set up intermachine communication. db? ipc over tcp/ip?
-        # work ok as is, if resources become strained consider implementation
+    set_sql = ', '.join( '%s = %%s' % ( feature ) for feature in get_feature_names( args ) )
+    update_sql = 'UPDATE {0} SET {1} WHERE variant_name = %s'.format( args.table, set_sql )
 
-        sys.stderr.write( 'processing %s\n' % ( os.path.basename( filename ) ) )
-        sys.stderr.flush()
-        fh = open( filename )
-        for line in fh:
-            if args.header_starter:
-                if line.startswith( args.header_starter ): continue
-            snp_name, value = process_line( line, args )
-            curs.execute( update_sql, [ value, snp_name ] )
-            values.append( value )
-        fh.close()
-    sys.stderr.write( "committing\n" )
-    conn.commit()
+    add_summary_columns( args )
 
-    if args.create_index:
-        sys.stderr.write( "creating index\n" )
-        index_sql = 'create index on {0} ( {1} )'.format( args.table, args.db_column_name ) 
-        curs.execute( index_sql )
+    index_defs = []
+    if args.defer_indexes:
+        index_defs = defer_indexes( args )
+
+    stats = get_feature_stats( args )
+    n_values = 0
+    try:
+        if args.bulk or args.workers > 1 or args.commit_every:
+            if args.commit_every:
+                n_values, n_updated, n_unknown = checkpointed_load( args, stats, update_sql, state )
+            elif args.workers > 1:
+                n_values, n_updated, n_unknown = parallel_load( args, stats )
+            else:
+                n_values, n_updated, n_unknown = bulk_load( iter_snp_values( args ), args, stats )
+            sys.stderr.write( "loaded %d values, updated %d rows, %d unknown variant names\n" % ( n_values,
+                                                                                                  n_updated,
+                                                                                                  n_unknown ) )
+        else:
+            for row in iter_snp_values( args ):
+                curs.execute( update_sql, row[1:] + row[:1] )
+                if curs.rowcount:
+                    add_stats( stats, row[1:] )
+                n_values += 1
+        sys.stderr.write( "committing\n" )
         conn.commit()
 
-    # add to summary
-    summary_sql = '''INSERT INTO {0} (feature_name, feature_datatype, feature_count, feature_range )
-                     VALUES ( %s, %s, %s, %s )
-                     ON CONFLICT DO UPDATE 
-                       SET feature_name = %s, feature_datatype = %s, 
-                           feature_count = %s, feature_range = %s'''.format( args.summary_table )
+    # whatever stopped the load, including ctrl-c or sys.exit, put back the
+    # indexes that were dropped for it, unless the load can be resumed: the 
+    # rebuild may take hours, and --resume would only drop them again
+    except:
+        if index_defs and args.journal:
+            sys.stderr.write( "load stopped, the dropped indexes were not rebuilt. rerun with --resume "
+                              "to finish the load, which rebuilds them, or run the CREATE INDEX "
+                              "statements saved in %s\n" % ( get_index_file( args ) ) )
+        elif index_defs:
+            sys.stderr.write( "load failed, rebuilding the dropped indexes\n" )
+            try:
+                conn.rollback()
+                build_indexes( index_defs, args )
+                os.unlink( get_index_file( args ) )
+            except Exception, e:
+                sys.stderr.write( "Error: could not rebuild the indexes, their definitions "
+                                  "are in %s: %s\n" % ( get_index_file( args ), str( e ) ) )
+        raise
+
+    if args.create_index:
+        for feature in get_feature_names( args ):
+            index_defs.append( 'CREATE INDEX ON {0} ( {1} )'.format( args.table, feature ) )
+    build_indexes( index_defs, args )
+    if args.defer_indexes and os.path.exists( get_index_file( args ) ):
+        os.unlink( get_index_file( args ) )
+
+    # fresh planner statistics for filters on the columns
+    curs.execute( 'ANALYZE {0} ( {1} )'.format( args.table, ', '.join( get_feature_names( args ) ) ) )
+    conn.commit()
+
+    # add to summary, from the stats of the values applied during the load rather than a scan of the table
+    summary_sql = '''INSERT INTO {0} ( feature_name, feature_datatype, feature_count, feature_range,
+                                       feature_null_count, feature_mean, feature_quantiles )
+                     VALUES ( %s, %s, %s, %s, %s, %s, %s )
+                     ON CONFLICT ( feature_name ) DO UPDATE 
+                       SET feature_datatype = EXCLUDED.feature_datatype, 
+                           feature_count = EXCLUDED.feature_count, 
+                           feature_range = EXCLUDED.feature_range,
+                           feature_null_count = EXCLUDED.feature_null_count,
+                           feature_mean = EXCLUDED.feature_mean,
+                           feature_quantiles = EXCLUDED.feature_quantiles'''.format( args.summary_table )
 
-    if 'char' in args.db_column_datatype:
-        args.db_column_datatype = 'string'
+    for ( value_column, feature, datatype ), feature_stats in zip( args.features, stats ):
+        if 'char' in datatype:
+            datatype = 'string'
 
-    f_count = len( values )
-    f_range = get_range( args )
+        f_count = feature_stats.count
+        f_range = get_range( datatype, feature_stats )
+        f_quantiles = None
+        if feature_stats.numeric:
+            q2value = feature_stats.quantiles( QUANTILES )
+            f_quantiles = json.dumps( dict( ( str( q ), value ) for q, value in q2value.items() ), 
+                                      sort_keys=True )
 
-    curs.execute( summary_sql, [ args.db_column_name, args.db_column_datatype, f_count, f_range ] )
+        curs.execute( summary_sql, [ feature, datatype, f_count, f_range,
+                                     feature_stats.nulls, feature_stats.mean(), f_quantiles ] )
     conn.commit()
                                 
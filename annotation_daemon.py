@@ -0,0 +1,242 @@
+#! /app/easybuild/software/Python/2.7.13-foss-2016b/bin/python
+
+import os
+import sys
+import argparse
+import errno
+import getpass
+import json
+import signal
+import socket
+import textwrap
+import time
+import traceback
+
+# also sets up the path for psycopg2
+import annotation_db
+import psycopg2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser( formatter_class=argparse.RawDescriptionHelpFormatter,
+                                      description=textwrap.dedent( '''\
+Long-running annotation service. Keeps a pool of worker processes, each
+holding an open db connection and the feature metadata, and answers
+annotation_db.py requests sent over a local unix socket.
+''' ) )
+
+    parser.add_argument( '--creds_file',
+                         help='''tab-separated credentials file with username, password,
+                                 port number, and db host, in that order. default:
+                                 /home/cconnoll/chuckworking/annotation_db/gecco_db_creds''',
+                         default='/home/cconnoll/chuckworking/annotation_db/gecco_db_creds' )
+    parser.add_argument( '--debug', action='store_true' )
+    parser.add_argument( '--meta_cache', help='metadata cache file, see annotation_db.py' )
+    parser.add_argument( '--meta_cache_max_age', type=float, default=86400,
+                         help='seconds before metadata is refreshed from the db, default: 86400' )
+    parser.add_argument( '--socket',
+                         default=os.environ.get( 'ANNOTATION_DB_SOCKET',
+                                                 '/tmp/annotation_db_%s.sock' % ( getpass.getuser() ) ),
+                         help='''unix socket to listen on.
+                                 default: $ANNOTATION_DB_SOCKET or /tmp/annotation_db_<user>.sock''' )
+    parser.add_argument( '--workers', type=int, default=4,
+                         help='number of worker processes, ie db connections; default: 4' )
+    args = parser.parse_args()
+
+    if not args.meta_cache:
+        args.meta_cache = annotation_db.get_meta_cache_file( args.creds_file )
+    args.db_key = annotation_db.get_db_key( args.creds_file )
+
+    return args
+
+
+# open a listening socket, refusing to replace the socket of a live daemon,
+# or to touch a path that isn't a socket of ours
+# param: string, socket path
+# returns: socket object
+# throws: ValueError if another daemon is listening on the path, or the path
+#         belongs to another user
+def get_listener( path ):
+    if os.path.lexists( path ):
+        annotation_db.check_socket_owner( path )
+        probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        try:
+            probe.connect( path )
+            probe.close()
+            raise ValueError( "a daemon is already listening on %s" % ( path ) )
+        except socket.error:
+            os.unlink( path )
+
+    listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    # the workers hold db credentials; only our user may talk to them
+    old_umask = os.umask( 0077 )
+    listener.bind( path )
+    os.umask( old_umask )
+    listener.listen( 128 )
+
+    return listener
+
+
+# make sure the worker's connection and metadata are usable before a request
+# param: argparse Namespace of the daemon
+# param: (optional) boolean, refresh metadata from the db whatever its age
+# returns: nothing
+# throws: nothing
+def refresh_worker( args, refresh=False ):
+    conn = annotation_db.CONN
+    if conn is not None and conn.closed:
+        annotation_db.CONN, annotation_db.CURS = None, None
+    annotation_db.db_connect( args.creds_file )
+
+    meta = annotation_db.META
+    if refresh or meta is None or time.time() - meta['created'] >= args.meta_cache_max_age:
+        annotation_db.META = annotation_db.load_meta( args.meta_cache, args.meta_cache_max_age,
+                                                      args.creds_file, refresh )
+
+
+# answer one request: a json line of annotation_db.py arguments, answered with
+# an accept or decline status line, then the output rows and a status line.
+# requests for another db than the daemon's are declined, so the client
+# connects to that db itself
+# param: connected socket
+# param: argparse Namespace of the daemon
+# returns: nothing
+# throws: nothing
+def handle_request( conn_sock, args ):
+    fh = conn_sock.makefile( 'rwb' )
+    try:
+        request = argparse.Namespace( **json.loads( fh.readline() ) )
+
+        db_key = getattr( request, 'db_key', None )
+        if db_key is not None and db_key != args.db_key:
+            fh.write( annotation_db.DAEMON_STATUS + 'DECLINE\tdaemon is connected to %s, not %s\n' % (
+                args.db_key, db_key ) )
+        else:
+            fh.write( annotation_db.DAEMON_STATUS + 'ACCEPT\n' )
+            fh.flush()
+
+            # same db, so the daemon's own credentials and metadata cache are used
+            request.creds_file = args.creds_file
+            request.meta_cache = args.meta_cache
+            request.meta_cache_max_age = args.meta_cache_max_age
+            refresh_worker( args, getattr( request, 'refresh_meta', False ) )
+            # a variants file of stdin is streamed by the client after the request line
+            annotation_db.STDIN = fh
+            annotation_db.run( request, fh )
+            annotation_db.CONN.rollback()
+            fh.write( annotation_db.DAEMON_STATUS + 'OK\n' )
+
+    except Exception, e:
+        if args.debug:
+            traceback.print_exc()
+
+        # drop the connection if it broke, otherwise just end the transaction
+        conn = annotation_db.CONN
+        if conn is not None:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+
+        try:
+            msg = str( e ).replace( '\n', ' ' )
+            fh.write( annotation_db.DAEMON_STATUS + 'ERROR\t%s\n' % ( msg ) )
+        except socket.error:
+            pass
+
+    annotation_db.STDIN = None
+    try:
+        fh.close()
+    except socket.error:
+        pass
+    conn_sock.close()
+
+
+# worker process: accept and answer requests until killed
+# param: listening socket
+# param: argparse Namespace of the daemon
+# returns: never
+def serve( listener, args ):
+    signal.signal( signal.SIGTERM, signal.SIG_DFL )
+    signal.signal( signal.SIGINT, signal.SIG_DFL )
+    refresh_worker( args )
+
+    while True:
+        try:
+            conn_sock, address = listener.accept()
+        except socket.error, e:
+            if e.errno == errno.EINTR: continue
+            raise
+        handle_request( conn_sock, args )
+
+
+# fork a worker process
+# param: listening socket
+# param: argparse Namespace of the daemon
+# returns: pid of worker
+def spawn_worker( listener, args ):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve( listener, args )
+        except Exception:
+            traceback.print_exc()
+        os._exit( 1 )
+
+    return pid
+
+
+
+################################################################################
+################################################################################
+##
+## main
+##
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    try:
+        listener = get_listener( args.socket )
+    except ValueError, e:
+        sys.stderr.write( "Error: %s\n" % ( str( e ) ) )
+        sys.exit( 1 )
+
+    # warm the metadata cache once, so the workers don't all fetch it
+    annotation_db.META = annotation_db.load_meta( args.meta_cache, args.meta_cache_max_age,
+                                                  args.creds_file )
+    if annotation_db.CONN is not None:
+        annotation_db.CONN.close()
+        annotation_db.CONN, annotation_db.CURS = None, None
+
+    workers = set()
+    def shutdown( signum, frame ):
+        for pid in workers:
+            try:
+                os.kill( pid, signal.SIGTERM )
+            except OSError:
+                pass
+        if os.path.exists( args.socket ):
+            os.unlink( args.socket )
+        sys.exit( 0 )
+
+    signal.signal( signal.SIGTERM, shutdown )
+    signal.signal( signal.SIGINT, shutdown )
+
+    for i in range( args.workers ):
+        workers.add( spawn_worker( listener, args ) )
+    sys.stderr.write( "listening on %s with %d workers\n" % ( args.socket, args.workers ) )
+
+    # replace workers that die, eg after losing the db
+    while True:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR: continue
+            raise
+        workers.discard( pid )
+        sys.stderr.write( "worker %d exited, restarting\n" % ( pid ) )
+        time.sleep( 1 )
+        workers.add( spawn_worker( listener, args ) )
@@ -2,16 +2,27 @@
 
 import os
 import sys
+import getpass
 
 # or be sure psycopg2 can be loaded
 sys.path.append( '/app/easybuild/software/Python/2.7.13-foss-2016b/lib/python2.7/site-packages' )
 
 import psycopg2
+import psycopg2.extensions
 import argparse
 import re
-import select
+import contextlib
+import itertools
+import json
+import time
+import socket
+import stat
 import textwrap
+import threading
 import traceback
+import Queue
+
+from cStringIO import StringIO
 
 
 # An iterator that uses fetchmany to keep memory usage down
@@ -28,30 +39,365 @@ def ResultIter(cursor, arraysize=1000):
             yield result
 
 
+# rows fetched per round trip by server-side cursors
+FETCH_SIZE = 10000
+SERVER_CURSOR_COUNT = 0
+
+# a named cursor keeps the result set on the server, so rows can be
+# written as they arrive instead of being held in memory
+# param: none
+# returns: psycopg2 named cursor on the global connection
+# throws: nothing
+def get_server_cursor():
+    global SERVER_CURSOR_COUNT
+    SERVER_CURSOR_COUNT += 1
+    curs = CONN.cursor( name='annotation_db_%d' % ( SERVER_CURSOR_COUNT ) )
+    curs.itersize = FETCH_SIZE
+    return curs
+
+
 
+# --profile: wall time per phase, rows, and db round trips; None when not profiling
+PROFILE = None
+PROFILE_LOCK = threading.Lock()
 
 # param: none
-# returns: list of feature names
+# returns: nothing
 # throws: nothing
-def get_feature_names():
-    sql = '''SELECT feature_name FROM variant_annotation_feature_summary'''
+def start_profile():
+    global PROFILE
+    PROFILE = { 'start': time.time(), 'phases': {}, 'phase_order': [], 'current': None,
+                'round_trips': 0, 'rows_fetched': 0, 'rows_written': 0, 'main_query': None }
+
+
+# param: string, phase name
+# param: float, seconds to add to phase
+# returns: nothing
+# throws: nothing
+def add_phase_time( phase, seconds ):
+    PROFILE_LOCK.acquire()
+    if not phase in PROFILE['phases']:
+        PROFILE['phase_order'].append( phase )
+        PROFILE['phases'][phase] = 0.0
+    PROFILE['phases'][phase] += seconds
+    PROFILE_LOCK.release()
+
+
+# time a block as a named phase; db calls inside it count toward the phase,
+# db calls outside any phase count as 'query' or 'fetch'
+# param: string, phase name
+@contextlib.contextmanager
+def profile_phase( phase ):
+    if PROFILE is None or PROFILE['current'] is not None:
+        yield
+        return
+
+    PROFILE['current'] = phase
+    start = time.time()
+    try:
+        yield
+    finally:
+        PROFILE['current'] = None
+        add_phase_time( phase, time.time() - start )
+
+
+# param: none
+# returns: True in the main thread, False in a thread of parallel_get_variants()
+# throws: nothing
+def is_main_thread():
+    return isinstance( threading.current_thread(), threading._MainThread )
+
+
+# record the query for explain_main_query(), unless a query streamed from
+# a named cursor has been recorded already
+# param: string, sql
+# param: list of sql params, or None
+# param: boolean, the query is streamed from a named cursor
+# returns: nothing
+# throws: nothing
+def set_main_query( sql, args, named ):
+    PROFILE_LOCK.acquire()
+    main_query = PROFILE['main_query']
+    if main_query is None or ( named and not main_query[2] ):
+        PROFILE['main_query'] = ( sql, args, named )
+    PROFILE_LOCK.release()
+
+
+# param: string, 'query' or 'fetch'
+# param: float, start time of db call
+# param: integer number of round trips
+# param: integer number of rows fetched
+# returns: nothing
+# throws: nothing
+def profile_db_call( phase, start, round_trips, rows ):
+    # threads of parallel_get_variants() overlap the main thread, so keep them apart
+    if not is_main_thread():
+        phase += ' (workers)'
+    elif PROFILE['current'] is not None:
+        phase = None
+
+    if phase:
+        add_phase_time( phase, time.time() - start )
+
+    PROFILE_LOCK.acquire()
+    PROFILE['round_trips'] += round_trips
+    PROFILE['rows_fetched'] += rows
+    PROFILE_LOCK.release()
+
+
+# cursor that counts round trips, rows and time for --profile
+class ProfilingCursor( psycopg2.extensions.cursor ):
+
+    def execute( self, sql, args=None ):
+        if PROFILE is None:
+            return psycopg2.extensions.cursor.execute( self, sql, args )
+
+        # the main query is the first streamed from a named cursor, 
+        # else the first run outside a phase. only the main thread's queries
+        # count; parallel_get_variants() records its filter itself
+        if is_main_thread() and PROFILE['current'] is None:
+            set_main_query( sql, args, bool( self.name ) )
+
+        start = time.time()
+        result = psycopg2.extensions.cursor.execute( self, sql, args )
+        profile_db_call( 'query', start, 1, 0 )
+        return result
+
+    def fetchone( self ):
+        if PROFILE is None:
+            return psycopg2.extensions.cursor.fetchone( self )
+
+        start = time.time()
+        row = psycopg2.extensions.cursor.fetchone( self )
+        profile_db_call( 'fetch', start, int( bool( self.name ) ), int( row is not None ) )
+        return row
+
+    def fetchmany( self, size=None ):
+        if PROFILE is None:
+            return psycopg2.extensions.cursor.fetchmany( self, size or self.arraysize )
+
+        start = time.time()
+        rows = psycopg2.extensions.cursor.fetchmany( self, size or self.arraysize )
+        profile_db_call( 'fetch', start, int( bool( self.name ) ), len( rows ) )
+        return rows
+
+    def fetchall( self ):
+        if PROFILE is None:
+            return psycopg2.extensions.cursor.fetchall( self )
+
+        start = time.time()
+        rows = psycopg2.extensions.cursor.fetchall( self )
+        profile_db_call( 'fetch', start, int( bool( self.name ) ), len( rows ) )
+        return rows
+
+    def copy_from( self, *args, **kwargs ):
+        if PROFILE is None:
+            return psycopg2.extensions.cursor.copy_from( self, *args, **kwargs )
+
+        start = time.time()
+        result = psycopg2.extensions.cursor.copy_from( self, *args, **kwargs )
+        profile_db_call( 'query', start, 1, 0 )
+        return result
+
+
+# param: none
+# returns: seconds recorded in phases of the main thread
+# throws: nothing
+def get_phase_total():
+    return sum( [ seconds for phase, seconds in PROFILE['phases'].items() 
+                  if not phase.endswith( '(workers)' ) ] )
+
+
+# EXPLAIN (ANALYZE, BUFFERS) runs the main query again, on the main connection
+# param: none
+# returns: list of plan lines, empty if there was no query
+# throws: nothing
+def explain_main_query():
+    if PROFILE['main_query'] is None or CONN is None:
+        return []
+
+    sql, args, named = PROFILE['main_query']
+    with profile_phase( 'explain' ):
+        try:
+            CURS.execute( 'EXPLAIN (ANALYZE, BUFFERS) ' + sql, args )
+            return [ row[0] for row in CURS.fetchall() ]
+        except psycopg2.Error, e:
+            CONN.rollback()
+            return [ 'EXPLAIN failed: %s' % ( str( e ).strip() ) ]
+
+
+# write the --profile summary to stderr, and as json if asked
+# param: (optional) string, filepath for json output
+# returns: nothing
+# throws: nothing
+def print_profile( json_file=None ):
+    explain = explain_main_query()
+    total = time.time() - PROFILE['start']
+    rows_per_sec = PROFILE['rows_written'] / total if total > 0 else 0.0
+
+    sys.stderr.write( '# profile\n' )
+    for phase in PROFILE['phase_order']:
+        sys.stderr.write( '%-20s %10.3f s\n' % ( phase, PROFILE['phases'][phase] ) )
+    sys.stderr.write( '%-20s %10.3f s\n' % ( 'total', total ) )
+    sys.stderr.write( '%-20s %10d\n' % ( 'rows fetched', PROFILE['rows_fetched'] ) )
+    sys.stderr.write( '%-20s %10d\n' % ( 'rows written', PROFILE['rows_written'] ) )
+    sys.stderr.write( '%-20s %10.1f\n' % ( 'rows/sec', rows_per_sec ) )
+    sys.stderr.write( '%-20s %10d\n' % ( 'db round trips', PROFILE['round_trips'] ) )
+    if explain:
+        sys.stderr.write( '# EXPLAIN (ANALYZE, BUFFERS)\n' )
+        for line in explain:
+            sys.stderr.write( '%s\n' % ( line ) )
+
+    if json_file:
+        report = { 'phases': PROFILE['phases'], 'total_seconds': total,
+                   'rows_fetched': PROFILE['rows_fetched'], 'rows_written': PROFILE['rows_written'],
+                   'rows_per_sec': rows_per_sec, 'round_trips': PROFILE['round_trips'],
+                   'explain': explain }
+        fh = open( json_file, 'w' )
+        json.dump( report, fh, indent=2 )
+        fh.write( '\n' )
+        fh.close()
+
+
+
+
+
+# metadata for the annotation tables, filled by load_meta()
+# bump META_CACHE_VERSION whenever the cached layout changes
+META_CACHE_VERSION = 2
+META = None
+# seconds for which freshly fetched metadata is not reloaded for unknown names
+META_MIN_AGE = 60
+
+
+# one cheap query for a stamp of the metadata in the db: digests of the 
+# summary table and of the annotation table's columns. it changes whenever
+# add_annotation.py adds a column or updates the summary
+# param: none
+# returns: list of two strings, or None for an empty table
+# throws: nothing
+def get_meta_stamp():
+    sql = '''SELECT ( SELECT md5( string_agg( ROW( feature_name, feature_datatype, feature_count, 
+                                                 feature_range )::text, ',' ORDER BY feature_name ) )
+                      FROM {0} ),
+                    ( SELECT md5( string_agg( column_name || ' ' || data_type, ',' 
+                                              ORDER BY ordinal_position ) )
+                      FROM information_schema.columns
+                      WHERE table_schema = %s AND table_name = %s )'''.format( SUMMARY_TABLE )
+    CURS.execute( sql, [ SCHEMA, VAR_TABLE ] )
+    return list( CURS.fetchone() )
+
+
+# fetch everything the metadata functions need from the db, 
+# one query for the summary table, one for the column datatypes and
+# one for the stamp the cache is checked against
+# param: none
+# returns: dict with version, creation time, stamp, features and columns
+# throws: nothing
+def fetch_meta():
+    sql = '''SELECT feature_name, feature_datatype, feature_count, feature_range 
+             FROM {0}'''.format( SUMMARY_TABLE )
     CURS.execute( sql )
-    features = []
-    for row in CURS.fetchall():
-        features.append( row[0] )
 
-    return features
+    features = {}
+    for f_name, f_dtype, f_count, f_range in CURS.fetchall():
+        features[f_name] = { 'count': f_count, 'range':f_range, 'dtype':f_dtype }
 
-def get_column_names():
-    sql = '''SELECT column_name FROM information_schema.columns
-             WHERE table_schema = %s AND table_name = %s'''
+    sql = '''SELECT column_name, data_type FROM information_schema.columns
+             WHERE table_schema = %s AND table_name = %s
+             ORDER BY ordinal_position'''
     CURS.execute( sql, [ SCHEMA, VAR_TABLE ] )
+    columns = [ list( row ) for row in CURS.fetchall() ]
+
+    return { 'version': META_CACHE_VERSION, 'created': time.time(), 'stamp': get_meta_stamp(),
+             'features': features, 'columns': columns }
 
-    column_names = []
-    for row in ResultIter( CURS ):
-        column_names.append( row[0] )
 
-    return column_names
+# read metadata from the cache file, refreshing it from the db if it is 
+# missing, from an older cache version, older than max_age seconds, or refresh is set
+# param: string, filepath to cache file
+# param: number, max age of cache in seconds
+# param: string, path to credentials file
+# param: (optional) boolean, force refresh from db
+# returns: metadata dict, see fetch_meta()
+# throws: nothing
+def load_meta( cache_file, max_age, creds_file, refresh=False ):
+    if not refresh and os.path.isfile( cache_file ):
+        try:
+            fh = open( cache_file )
+            meta = json.load( fh )
+            fh.close()
+            if meta.get( 'version' ) == META_CACHE_VERSION and \
+               time.time() - meta.get( 'created', 0 ) < max_age:
+                return meta
+        except ( IOError, ValueError ):
+            pass
+
+    db_connect( creds_file )
+    meta = fetch_meta()
+
+    # write to a temp file and rename so concurrent runs never see a partial cache
+    try:
+        cache_dir = os.path.dirname( cache_file )
+        if cache_dir and not os.path.isdir( cache_dir ):
+            os.makedirs( cache_dir )
+        tmp_file = '%s.%d' % ( cache_file, os.getpid() )
+        fh = open( tmp_file, 'w' )
+        json.dump( meta, fh )
+        fh.close()
+        os.rename( tmp_file, cache_file )
+    except ( IOError, OSError ), e:
+        sys.stderr.write( "can't write metadata cache %s: %s\n" % ( cache_file, str( e ) ) )
+
+    return meta
+
+
+# the cache only expires with age, so a feature added since it was written,
+# eg by add_annotation.py, would be missing until then. a request that takes
+# the whole list of columns or features from the metadata, --annotate without
+# --features or --describe_features without names, first checks the cache's 
+# stamp against the db. otherwise, if the request names a feature or column 
+# the metadata doesn't have, it is reloaded before the name is rejected; 
+# metadata fetched in the last META_MIN_AGE seconds is trusted, so misspelled
+# names don't reload it on every request.
+# param: argparse Namespace
+# returns: nothing
+# throws: nothing
+def refresh_meta_if_stale( args ):
+    global META
+    if args.snapshot:
+        return
+
+    if ( args.annotate and not args.features ) or args.describe_features == []:
+        db_connect( args.creds_file )
+        if get_meta_stamp() == META.get( 'stamp' ):
+            return
+    else:
+        if time.time() - META.get( 'created', 0 ) < META_MIN_AGE:
+            return
+
+        names = list( args.features or [] ) + list( args.describe_features or [] )
+        for where in args.where or []:
+            fields = where.split( None, 1 )
+            if fields:
+                names.append( fields[0].lower() )
+
+        known = set( get_feature_names() ) | set( get_column_names() )
+        if all( name in known for name in names ):
+            return
+
+    cache_file = args.meta_cache or get_meta_cache_file( args.creds_file )
+    META = load_meta( cache_file, args.meta_cache_max_age, args.creds_file, refresh=True )
+
+
+# param: none
+# returns: list of feature names
+# throws: nothing
+def get_feature_names():
+    return META['features'].keys()
+
+def get_column_names():
+    return [ column_name for column_name, data_type in META['columns'] ]
 
     
 
@@ -67,16 +413,9 @@ def get_feature_count( features ):
 
     validate_feature_names( features )
 
-    # sql_tmpl = 'SELECT COUNT( %s ) FROM {0}.{1}'.format( SCHEMA, TABLE )
-
-    sql = '''SELECT feature_count 
-             FROM variant_annotation_feature_summary
-             WHERE feature_name = %s'''
     feature2count = {}
     for feature in features:
-        CURS.execute( sql, [ feature ] )
-        count = CURS.fetchone()[0]
-        feature2count[feature] = count
+        feature2count[feature] = META['features'][feature]['count']
 
     return feature2count
 
@@ -90,14 +429,9 @@ def get_feature_range( features ):
 
     validate_feature_names( features )
 
-    sql = '''SELECT feature_range 
-             FROM variant_annotation_feature_summary 
-             WHERE feature_name = %s'''
-
     feature2range = {}
     for feature in features:
-        CURS.execute( sql, [ feature ] )
-        feature2range[feature] = CURS.fetchone()[0]
+        feature2range[feature] = META['features'][feature]['range']
 
     return feature2range
 
@@ -110,15 +444,11 @@ def get_feature2datatype( features ):
 
     validate_feature_names( features )
 
-
-    sql = '''SELECT data_type FROM information_schema.columns
-             WHERE table_schema = 'public' AND table_name = 'variant_annotation' AND column_name = %s'''
+    column2datatype = dict( META['columns'] )
 
     feature2datatype = {}
     for feature in features:
-        # CURS.execute( sql, [ SCHEMA, TABLE, feature ] )
-        CURS.execute( sql, [ feature ] )
-        datatype = CURS.fetchone()[0]
+        datatype = column2datatype.get( feature, '' )
 
         if datatype.startswith( 'char' ):
             datatype = str
@@ -201,6 +531,29 @@ Output is written to STDOUT
                          default='/home/cconnoll/chuckworking/annotation_db/gecco_db_creds' )
     
     parser.add_argument( '--debug', action='store_true' )
+    parser.add_argument( '--profile', action='store_true',
+                         help='''print time per phase, rows fetched and written, rows/sec, db round 
+                                 trips, and EXPLAIN (ANALYZE, BUFFERS) of the main query to STDERR;
+                                 the main query is run a second time for the EXPLAIN''' )
+    parser.add_argument( '--profile_json', help='also write the --profile report as json to this file' )
+    parser.add_argument( '--socket', 
+                         default=os.environ.get( 'ANNOTATION_DB_SOCKET',
+                                                 '/tmp/annotation_db_%s.sock' % ( getpass.getuser() ) ),
+                         help='''unix socket of a running annotation_daemon.py; requests are sent 
+                                 to the daemon if one is listening, otherwise run here. a socket
+                                 that isn't owned by this user is never used. default: $ANNOTATION_DB_SOCKET or /tmp/annotation_db_<user>.sock''' )
+    parser.add_argument( '--no_daemon', action='store_true',
+                         help='connect to the db directly even if a daemon is running' )
+    parser.add_argument( '--meta_cache', 
+                         help='''file in which to cache feature metadata between runs, 
+                                 default: ~/.cache/annotation_db/<host>_<port>_<db>.json''' )
+    parser.add_argument( '--meta_cache_max_age', type=float, default=86400,
+                         help='seconds before cached metadata is refreshed from the db, default: 86400' )
+    parser.add_argument( '--refresh_meta', action='store_true',
+                         help='refresh cached metadata from the db' )
+    parser.add_argument( '--create_region_index', action='store_true',
+                         help='''create the ( chrom, position ) expression index used by --region;
+                                 needs create privilege on the annotation table''' )
     # metadata
     parser.add_argument( '--describe_features', nargs='*',
                          help='''print feature name, datatype, number of variants, and 
@@ -210,11 +563,25 @@ Output is written to STDOUT
     parser.add_argument( '-a', '--annotate', action='store_true', 
                          help='annotate a list of variants, requires --feature' )
     parser.add_argument( '--features', help='valid annotation name', nargs='+' )
+    parser.add_argument( '--bulk', action='store_true',
+                         help='''with --annotate, load the variants into a temp table and 
+                                 annotate them all with one join instead of one query per variant''' )
 
     # get list of variants based on feature criteria
     parser.add_argument( '--filter', action='store_true', 
                          help='get variants by specified criteria. Requires "--where".' )
 
+    # summarize variants by criteria in the db
+    parser.add_argument( '--aggregate', action='store_true',
+                         help='''instead of the variants passing "--where" and "--region", print their
+                                 number, number per chromosome, and for "--features" (default: the
+                                 features in "--where") count, min, max, mean, quantiles and a 
+                                 histogram if numeric, or the number of each value otherwise''' )
+    parser.add_argument( '--quantiles', default='0.05,0.25,0.5,0.75,0.95',
+                         help='comma-separated quantiles for --aggregate; default: 0.05,0.25,0.5,0.75,0.95' )
+    parser.add_argument( '--bins', type=int, default=10,
+                         help='number of histogram bins for --aggregate; default: 10' )
+
     # filter criteria
     parser.add_argument( '--where', action='append', help='''"feature op val"; needs to be enclosed in quotes. 
                                                         feature is valid feature name;
@@ -223,15 +590,55 @@ Output is written to STDOUT
                                                         value is valid datatype for feature; 
                                                         example: "cadd gt 5", "di_are eq True"''' )
 
+    parser.add_argument( '--region', action='append',
+                         help='''with --filter, "chrom:start-end" or "chrom"; 1-based, inclusive.
+                                 may be repeated, and combined with --where; 
+                                 example: "chr1:1000000-2000000", "X"''' )
+    parser.add_argument( '--bed_file', help='with --filter, bed file of regions, as --region' )
+    parser.add_argument( '--workers', type=int, default=1,
+                         help='''with --filter, number of db connections to run the query on in 
+                                 parallel, split by id range; output is ordered by id. default: 1''' )
+
     parser.add_argument( '--variants_file', 
                          help='''file with list of variants, 1 per line, as variant_name or  rsID; 
-                                 use "stdin" to indicate reading from stdin''' )
+                                 use "stdin" or "-" to indicate reading from stdin''' )
     
+    # offline snapshots
+    parser.add_argument( '--export_snapshot', metavar='DIR',
+                         help='''dump the annotation table into a local, memory-mapped snapshot 
+                                 in DIR; needs numpy''' )
+    parser.add_argument( '--snapshot', metavar='DIR',
+                         help='''run --describe_features, --annotate and --filter against the 
+                                 snapshot in DIR instead of the db; needs numpy''' )
+
     parser.add_argument( '-o', '--outfile', help='file to which to write output' )
+    parser.add_argument( '--format', choices=[ 'tsv', 'arrow', 'parquet', 'npz' ], default='tsv',
+                         help='''output format for --annotate and --filter: tab-separated text, 
+                                 Arrow IPC file, Parquet, or numpy .npz with 1 array per column.
+                                 the binary formats need --outfile. default: tsv''' )
     args = parser.parse_args()
 
-    if args.filter and not args.where:
-        raise ValueError( """specify variant selection criteria with '--where'.\n""" )
+    if args.profile_json:
+        args.profile = True
+
+    try:
+        args.quantiles = [ float( q ) for q in args.quantiles.split( ',' ) ]
+    except ValueError:
+        raise ValueError( "--quantiles should be comma-separated numbers between 0 and 1\n" )
+    for q in args.quantiles:
+        if q < 0 or q > 1:
+            raise ValueError( "--quantiles should be comma-separated numbers between 0 and 1\n" )
+    if args.bins < 1:
+        raise ValueError( "--bins should be at least 1\n" )
+
+    if args.format != 'tsv':
+        if not args.outfile:
+            raise ValueError( """--format %s requires '--outfile'.\n""" % ( args.format ) )
+        if not ( args.annotate or args.filter ):
+            raise ValueError( """--format %s is for '--annotate' or '--filter'.\n""" % ( args.format ) )
+
+    if args.filter and not ( args.where or args.region or args.bed_file ):
+        raise ValueError( """specify variant selection criteria with '--where', '--region' or '--bed_file'.\n""" )
 
     if args.annotate and not args.variants_file:
         raise ValueError( """specify variant names with '--variants_file'.\n""" )
@@ -262,12 +669,24 @@ def get_creds( creds_file ):
 def postgres_connect( db, creds_file ):
     user, pwd, port, host = get_creds( creds_file )
     dsn = 'host=%s port=%s dbname=%s user=%s password=%s' % ( host, port, db, user, pwd )
-    conn = psycopg2.connect( dsn )
+    conn = psycopg2.connect( dsn, cursor_factory=ProfilingCursor )
     curs = conn.cursor()
 
     return( conn, curs )
 
 
+# connect on first use, so runs answered from the metadata cache 
+# never open a connection
+# param: string, path to credentials file
+# returns: nothing
+# throws: nothing
+def db_connect( creds_file ):
+    global CONN, CURS
+    if CONN is None:
+        with profile_phase( 'connect' ):
+            CONN, CURS = postgres_connect( DB, creds_file )
+
+
 # param: string of the form 'feature op value'
 # returns: True
 # throws: ValueError if string is incorrectly formatted
@@ -317,19 +736,15 @@ def validate_where( where ):
 def variant_list( filename ):
     variants = []
     if filename:
-        fh = open( filename )
+        fh = open_variants_file( filename )
         for line in fh:
             line = line.rstrip( '\n' )
             if not line: continue
             if line.startswith( '#' ): continue
             
             variants.append( line )
-
-    while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-        line = sys.stdin.readline()
-        line = line.rstrip( '\n' )
-        if line:
-            variants.append( line )
+        if fh is not STDIN:
+            fh.close()
 
     return variants
             
@@ -341,10 +756,6 @@ def describe_features( features ):
     if not isinstance( features, list ):
         raise ValueError( "internal error: param is not a list" )
 
-    sql = '''SELECT feature_name, feature_datatype, Feature_count, feature_range
-             FROM variant_annotation_feature_summary 
-             WHERE feature_name = %s'''
-
     rows = [ [ '# name', 'datatype', 'count', 'range' ] ]
     all_features = get_feature_names()
     for feature in features:
@@ -352,21 +763,39 @@ def describe_features( features ):
             msg = "feature not found: %s" % ( feature )
             raise ValueError( msg )
         else:
-            CURS.execute( sql, [ feature ] )
-            rows.append( list( CURS.fetchone() ) )
+            meta = META['features'][feature]
+            rows.append( [ feature, meta['dtype'], meta['count'], meta['range'] ] )
 
     return rows
 
 
 
-# param: where constraint in the form 'feature op value'
-# param: (optional) boolean to indicate whether to include rsid in output
-def get_variants( wheres ):
+# param: where constraint in the form 'feature op value [or value or value]'
+# returns: tuple of feature, op, list of values
+# throws: nothing
+def parse_where( where ):
+    where = where.lower()
+
+    if 'or' in where:
+        feature, op, values = where.split( None, 2 )
+        values = [ s.strip() for s in values.split( 'or' ) ]
+    else:
+        feature, op, value = where.split()
+        values = [value]
+
+    return ( feature, op, values )
+
+
+# param: list of where constraints in the form 'feature op value'
+# returns: tuple of output column names, sql WHERE condition, list of sql params
+# throws: ValueError if a constraint is invalid
+def build_filter( wheres ):
     if not isinstance( wheres, list ):
         raise ValueError( "internal error: param is not a list" )
 
-    for where in wheres:
-        validate_where( where )
+    with profile_phase( 'validate' ):
+        for where in wheres:
+            validate_where( where )
 
 
     op2symbol = { 'lt':'<', 'eq':'=', 'gt':'>' }
@@ -374,14 +803,7 @@ def get_variants( wheres ):
     vals = []
     all_clauses = []
     for where in wheres:
-        where = where.lower()
-
-        if 'or' in where:
-            feature, op, values = where.split( None, 2 )
-            values = [ s.strip() for s in values.split( 'or' ) ]
-        else:
-            feature, op, value = where.split()
-            values = [value]
+        feature, op, values = parse_where( where )
 
         validate_feature_names( [ feature ] )
 
@@ -402,17 +824,146 @@ def get_variants( wheres ):
     feature_names = [ 'variant_name', 'rsid' ]
     feature_names += features 
 
+    condition = ' AND '.join( all_clauses ) or 'TRUE'
+
+    return ( feature_names, condition, vals )
+
+
+# param: where constraint in the form 'feature op value'
+# yields: header, then 1 row per variant passing the constraints
+def get_variants( wheres ):
+    feature_names, condition, vals = build_filter( wheres )
+
     sql = 'SELECT {0} FROM variant_annotation '.format( ', '.join( feature_names ) )
-    sql += 'WHERE %s ' % ( ' AND '.join( all_clauses ) )
+    sql += 'WHERE %s ' % ( condition )
+
+    curs = get_server_cursor()
+    curs.execute( sql, vals )
+    yield feature_names
+    for row in ResultIter( curs, FETCH_SIZE ):
+        yield row
+    curs.close()
+
+
+# partitions per connection, so a slow partition doesn't leave the others idle
+PARTITIONS_PER_WORKER = 4
+# batches of FETCH_SIZE rows buffered for each partition not yet being written
+PARTITION_QUEUE_SIZE = 8
+
+# param: Queue
+# param: item to put on queue
+# param: threading.Event, set when the consumer has gone away
+# returns: False if stopped before item could be queued
+def put_until_stopped( queue, item, stop ):
+    while not stop.is_set():
+        try:
+            queue.put( item, timeout=1 )
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+# thread body for parallel_get_variants(): on its own connection, run partitions 
+# from the job queue and put batches of rows on each partition's result queue, 
+# followed by None, or by the exception if the query failed
+# param: string, partition sql
+# param: Queue of ( partition index, sql params )
+# param: list of result Queues, 1 per partition
+# param: threading.Event, set when the consumer has gone away
+# param: string, path to credentials file
+# param: string, snapshot id shared by all partitions
+# returns: nothing
+# throws: nothing
+def filter_worker( sql, jobs, results, stop, creds_file, snapshot ):
+    conn = None
+    while not stop.is_set():
+        try:
+            idx, params = jobs.get_nowait()
+        except Queue.Empty:
+            break
+
+        try:
+            if conn is None:
+                conn, curs = postgres_connect( DB, creds_file )
+                conn.set_session( isolation_level='REPEATABLE READ', readonly=True )
+                curs.execute( 'SET TRANSACTION SNAPSHOT %s', [ snapshot ] )
+
+            curs = conn.cursor( name='annotation_db_part_%d' % ( idx ) )
+            curs.itersize = FETCH_SIZE
+            curs.execute( sql, params )
+            while True:
+                batch = curs.fetchmany( FETCH_SIZE )
+                if not batch: break
+                if not put_until_stopped( results[idx], batch, stop ): break
+            curs.close()
+            put_until_stopped( results[idx], None, stop )
+
+        except Exception, e:
+            put_until_stopped( results[idx], e, stop )
+            break
+
+    if conn is not None:
+        conn.close()
+
+
+# run a filter as id-range partitions on several connections at once;
+# partitions are written in id order, so the output is the same on every run
+# param: list of where constraints in the form 'feature op value'
+# param: integer number of connections
+# param: string, path to credentials file
+# yields: header, then 1 row per variant passing the constraints
+def parallel_get_variants( wheres, workers, creds_file ):
+    feature_names, condition, vals = build_filter( wheres )
+
+    sql = 'SELECT {0} FROM variant_annotation '.format( ', '.join( feature_names ) )
+    if PROFILE is not None:
+        # explain the whole filter, not one partition's id range of it
+        set_main_query( sql + 'WHERE %s ' % ( condition ), vals, True )
+    sql += 'WHERE %s AND id >= %%s AND id < %%s ORDER BY id' % ( condition )
+
+    CURS.execute( 'SELECT MIN( id ), MAX( id ) FROM variant_annotation' )
+    id_min, id_max = CURS.fetchone()
+
+    yield feature_names
+    if id_min is None:
+        return
+
+    # all partitions read the same snapshot, even if the table is being loaded
+    CURS.execute( 'SELECT pg_export_snapshot()' )
+    snapshot = CURS.fetchone()[0]
+
+    n_partitions = workers * PARTITIONS_PER_WORKER
+    step = ( id_max - id_min ) // n_partitions + 1
+    jobs = Queue.Queue()
+    results = []
+    for lo in range( id_min, id_max + 1, step ):
+        jobs.put( ( len( results ), vals + [ lo, lo + step ] ) )
+        results.append( Queue.Queue( maxsize=PARTITION_QUEUE_SIZE ) )
+
+    stop = threading.Event()
+    for i in range( min( workers, len( results ) ) ):
+        thread = threading.Thread( target=filter_worker, 
+                                   args=( sql, jobs, results, stop, creds_file, snapshot ) )
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for result in results:
+            while True:
+                batch = result.get()
+                if batch is None: break
+                if isinstance( batch, Exception ):
+                    raise batch
+                for row in batch:
+                    yield row
+    finally:
+        stop.set()
 
-    CURS.execute( sql, vals )
-    rows = [ feature_names ]
-    for row in ResultIter( CURS ):
-        rows.append( row )
-    
-    return rows
 
 
+# numeric codes of the non-autosomes in variant names
+CHROM2NUM = { 'X':23, 'Y':24, 'XY':26 }
 
 # param: variant name in the form chrom:pos or chrom:pos_ref/alt
 # return: tuple of chrom, pos
@@ -424,12 +975,7 @@ def validate_variant_name( variant_name ):
     fields = variant_name.split( '_' )
     chrom, pos = fields[0].split( ':' )
     chrom = chrom.replace( 'chr', '' )
-    if chrom == 'X': 
-        chrom = 23
-    elif chrom == 'Y': 
-        chrom = 24
-    elif chrom == 'XY': 
-        chrom = 26
+    chrom = CHROM2NUM.get( chrom, chrom )
     try:
         int( chrom )
         int( pos )
@@ -440,20 +986,284 @@ def validate_variant_name( variant_name ):
     return ( chrom, pos )
 
 
+# chromosome and position of a variant name, as sql; --create_region_index 
+# indexes exactly these expressions so region queries can use the index
+CHROM_SQL = "substring( variant_name from '^(?:chr)?([^:]+):' )"
+POS_SQL = "substring( variant_name from ':([0-9]+)' )::bigint"
 
-def get_meta():
-    sql = '''SELECT feature_name, feature_datatype, feature_count, feature_range 
-             FROM variant_annotation_feature_summary'''
+# param: none
+# returns: nothing
+# throws: nothing
+def create_region_index():
+    CONN.rollback()
+    CONN.autocommit = True
+    sql = '''CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_region_idx 
+             ON {0} ( ( {1} ), ( {2} ) )'''.format( VAR_TABLE, CHROM_SQL, POS_SQL )
     CURS.execute( sql )
+    CURS.execute( 'ANALYZE %s' % ( VAR_TABLE ) )
+    CONN.autocommit = False
 
-    feature2meta = {}
-    for f_name, f_dtype, f_count, f_range in CURS.fetchall():
-        feature2meta[f_name] = { 'count': f_count, 'range':f_range, 'dtype':f_dtype }
 
-    return feature2meta
+# param: string, chromosome as in a variant name, with or without 'chr'
+# returns: integer chromosome code
+# throws: ValueError if chromosome is not recognized
+def get_chrom_code( chrom ):
+    chrom = chrom.replace( 'chr', '' )
+    try:
+        return int( CHROM2NUM.get( chrom.upper(), chrom ) )
+    except ValueError:
+        raise ValueError( "invalid chromosome: '%s'" % ( chrom ) )
 
 
-def annotate( variants_file, features ):
+# param: string, 'chrom:start-end' or 'chrom'; 1-based, inclusive
+# returns: tuple of integer chromosome code, start, end
+# throws: ValueError if region is badly formed
+def parse_region( region ):
+    region = region.strip().replace( ',', '' )
+    try:
+        if ':' in region:
+            chrom, interval = region.split( ':' )
+            start, end = [ int( x ) for x in interval.split( '-' ) ]
+        else:
+            chrom, start, end = region, 1, 2 ** 31 - 1
+    except ValueError:
+        raise ValueError( "invalid region format: '%s', should be 'chrom:start-end'" % ( region ) )
+
+    if start > end:
+        raise ValueError( "region start is after end: '%s'" % ( region ) )
+
+    return ( get_chrom_code( chrom ), start, end )
+
+
+# param: string, filepath to bed file
+# returns: list of tuples of integer chromosome code, start, end; 1-based, inclusive
+# throws: ValueError if a line is badly formed
+def read_bed_file( bed_file ):
+    regions = []
+    fh = open( bed_file )
+    for line in fh:
+        line = line.rstrip( '\n' )
+        if not line: continue
+        if line.startswith( ( '#', 'track', 'browser' ) ): continue
+
+        fields = line.split( '\t' )
+        try:
+            chrom, start, end = fields[0], int( fields[1] ), int( fields[2] )
+        except ( IndexError, ValueError ):
+            raise ValueError( "invalid bed line: '%s'" % ( line ) )
+
+        # bed is 0-based, half-open
+        regions.append( ( get_chrom_code( chrom ), start + 1, end ) )
+    fh.close()
+
+    return regions
+
+
+# param: list of tuples of chromosome code, start, end
+# returns: sorted list of non-overlapping tuples of chromosome code, start, end
+# throws: nothing
+def merge_regions( regions ):
+    merged = []
+    for chrom, start, end in sorted( regions ):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            if end > merged[-1][2]:
+                merged[-1] = ( chrom, merged[-1][1], end )
+        else:
+            merged.append( ( chrom, start, end ) )
+
+    return merged
+
+
+# param: argparse Namespace
+# returns: merged list of regions from --region and --bed_file, see merge_regions()
+# throws: ValueError if a region is badly formed
+def get_regions( args ):
+    regions = [ parse_region( region ) for region in args.region or [] ]
+    if args.bed_file:
+        regions += read_bed_file( args.bed_file )
+
+    return merge_regions( regions )
+
+
+# param: list of merged regions, see get_regions()
+# returns: tuple of sql JOIN clause restricting variant_annotation to the regions, 
+#          list of sql params; the regions' order is in column region_idx
+# throws: nothing
+def build_region_join( regions ):
+    # a variant name may spell the chromosome as a number or a letter
+    num2chrom = dict( [ ( v, k ) for k, v in CHROM2NUM.items() ] )
+    region_rows = []
+    region_vals = []
+    for idx, ( chrom, start, end ) in enumerate( regions ):
+        for name in [ str( chrom ), num2chrom.get( chrom ) ]:
+            if name is None: continue
+            region_rows.append( '( %s, %s, %s, %s )' )
+            region_vals += [ name, start, end, idx ]
+
+    sql = '''JOIN ( VALUES {0} ) AS region ( region_chrom, region_start, region_end, region_idx ) 
+               ON {1} = region_chrom AND {2} BETWEEN region_start AND region_end'''.format( ', '.join( region_rows ),
+                                                                                       CHROM_SQL, POS_SQL )
+
+    return ( sql, region_vals )
+
+
+# all variants in the regions that pass the constraints, in position order
+# param: list of merged regions, see get_regions()
+# param: list of where constraints in the form 'feature op value'
+# yields: header, then 1 row per variant
+def get_region_variants( regions, wheres ):
+    feature_names, condition, vals = build_filter( wheres )
+    if not regions:
+        yield feature_names
+        return
+
+    join, region_vals = build_region_join( regions )
+    sql = '''SELECT {0} FROM variant_annotation {1}
+             WHERE {2} 
+             ORDER BY region_idx, {3}'''.format( ', '.join( feature_names ), join, condition, POS_SQL )
+
+    curs = get_server_cursor()
+    curs.execute( sql, region_vals + vals )
+    yield feature_names
+    for row in ResultIter( curs, FETCH_SIZE ):
+        yield row
+    curs.close()
+
+
+# summarize the variants passing the constraints inside the db, instead of 
+# pulling them: the number of variants, the number per chromosome, and for each 
+# feature, count, min, max, mean, quantiles and a histogram if it is numeric, 
+# or the count of each value otherwise
+# param: list of where constraints in the form 'feature op value'
+# param: list of merged regions, see get_regions(), or None for no region restriction
+# param: list of features to summarize, or None for the features in the constraints
+# param: list of quantiles, between 0 and 1
+# param: integer number of histogram bins
+# yields: header, then rows of statistic, feature, key, value
+def aggregate( wheres, regions, features, quantiles, bins ):
+    feature_names, condition, vals = build_filter( wheres )
+    if features is None:
+        features = []
+        for feature in feature_names[2:]:
+            if not feature in features:
+                features.append( feature )
+    feature2datatype = get_feature2datatype( features )
+
+    from_sql = 'FROM variant_annotation'
+    if regions is not None:
+        if not regions:
+            raise ValueError( "no regions given" )
+        join, region_vals = build_region_join( regions )
+        from_sql += ' ' + join
+        vals = region_vals + vals
+    from_sql += ' WHERE %s' % ( condition )
+
+    yield [ 'statistic', 'feature', 'key', 'value' ]
+
+    CURS.execute( 'SELECT COUNT(*) %s' % ( from_sql ), vals )
+    yield [ 'count', 'variants', None, CURS.fetchone()[0] ]
+
+    CURS.execute( 'SELECT %s, COUNT(*) %s GROUP BY 1 ORDER BY 1' % ( CHROM_SQL, from_sql ), vals )
+    for chrom, count in CURS.fetchall():
+        yield [ 'chrom_count', 'variants', chrom, count ]
+
+    for feature in features:
+        if feature2datatype[feature] in ( int, float ):
+            sql = '''SELECT COUNT( {0} ), MIN( {0} ), MAX( {0} ), AVG( {0} ), 
+                            percentile_cont( %s::double precision[] ) WITHIN GROUP ( ORDER BY {0} ) 
+                     {1}'''.format( feature, from_sql )
+            CURS.execute( sql, [ quantiles ] + vals )
+            count, f_min, f_max, f_mean, f_quantiles = CURS.fetchone()
+
+            yield [ 'count', feature, None, count ]
+            yield [ 'min', feature, None, f_min ]
+            yield [ 'max', feature, None, f_max ]
+            yield [ 'mean', feature, None, f_mean ]
+            for q, value in zip( quantiles, f_quantiles or [] ):
+                yield [ 'quantile', feature, q, value ]
+
+            if not count:
+                continue
+
+            # width_bucket puts the max in bucket bins + 1, so fold it into the last bin
+            width = float( f_max - f_min ) / bins
+            if width == 0:
+                yield [ 'histogram', feature, '[%s, %s]' % ( f_min, f_max ), count ]
+                continue
+
+            sql = '''SELECT LEAST( width_bucket( {0}::double precision, %s::double precision, 
+                                          %s::double precision, %s ), %s ), COUNT(*) 
+                     {1} AND {0} IS NOT NULL GROUP BY 1 ORDER BY 1'''.format( feature, from_sql )
+            CURS.execute( sql, [ f_min, f_max, bins, bins ] + vals )
+            for bucket, bucket_count in CURS.fetchall():
+                lo = f_min + ( bucket - 1 ) * width
+                hi = f_min + bucket * width
+                bracket = ']' if bucket == bins else ')'
+                yield [ 'histogram', feature, '[%s, %s%s' % ( lo, hi, bracket ), bucket_count ]
+
+        else:
+            sql = 'SELECT {0}, COUNT(*) {1} GROUP BY 1 ORDER BY 2 DESC'.format( feature, from_sql )
+            CURS.execute( sql, vals )
+            for value, count in CURS.fetchall():
+                yield [ 'value_count', feature, value, count ]
+
+
+
+# param: none
+# returns: dictionary where keys are features, values are dicts of count, range, dtype
+# throws: nothing
+def get_meta():
+    return META['features']
+
+
+# param: line from variants file
+# returns: 'rsid' or 'variant_name'
+# throws: ValueError if line is neither
+def get_input_type( line ):
+    if line.startswith( 'rs' ):
+        return 'rsid'
+    elif re.search( r'\d{1,2}:\d+', line ):
+        return 'variant_name'
+    else:
+        raise ValueError( 'unknown input type' )
+
+
+# param: string, variants file name
+# returns: True if the name means stdin
+def is_stdin( variants_file ):
+    return variants_file in [ 'stdin', '-' ]
+
+
+# open a variants file. stdin is read blocking until end of input, through 
+# a large buffer; in the daemon it is the request's stream from the client
+# param: string, filepath to variants file, or 'stdin'
+# returns: file handle
+def open_variants_file( variants_file ):
+    if not is_stdin( variants_file ):
+        return open( variants_file )
+    if STDIN is not None:
+        return STDIN
+    return os.fdopen( os.dup( sys.stdin.fileno() ), 'rb', STDIN_BUFFER_SIZE )
+
+
+# param: string, filepath to variants file, or 'stdin'
+# yields: tuple of input type, variant name or rsID for each line
+# throws: ValueError if a line is neither rsID nor variant name
+def iter_variants( variants_file ):
+    fh = open_variants_file( variants_file )
+    for line in fh:
+        line = line.rstrip( '\n' )
+        if not line: continue
+        if line.startswith( '#' ): continue
+
+        yield ( get_input_type( line ), line )
+    if fh is not STDIN:
+        fh.close()
+
+
+# param: list of features or None for all columns
+# returns: list of column names, starting with variant_name, rsid
+def get_annotation_features( features ):
     if features is None:
         features = get_column_names()
 
@@ -463,88 +1273,379 @@ def annotate( variants_file, features ):
         except ValueError, e:
             pass
 
-    features = [ 'variant_name', 'rsid' ] + features
+    return [ 'variant_name', 'rsid' ] + features
+
+
+# param: string, filepath to variants file
+# param: list of features or None for all columns
+# yields: header, then 1 row per matching variant
+def annotate( variants_file, features ):
+    features = get_annotation_features( features )
 
     sql_tmpl = '''SELECT {0}
                   FROM variant_annotation 
                   WHERE %s = %%s'''.format( ','.join( features ) )
 
-    rows = [ features ]
-    fh = open( variants_file )
-    for line in fh:
-        line = line.rstrip( '\n' )
-        if not line: continue
-        if line.startswith( '#' ): continue
-        
-        input_type = ''
-        if line.startswith( 'rs' ):
-            input_type = 'rsid'
-        elif re.search( r'\d{1,2}:\d+', line ):
-            input_type = 'variant_name'
-        else:
-            raise ValueError( 'unknown input type' )
-
-        CURS.execute( sql_tmpl % ( input_type ), [ line ] )
+    yield features
+    for input_type, name in iter_variants( variants_file ):
+        CURS.execute( sql_tmpl % ( input_type ), [ name ] )
         for row in ResultIter( CURS ):
-            rows.append( list( row ) )
-    fh.close()
+            yield list( row )
+
+
+# copy lines of a variants file into the input_variants temp table
+# param: string, filepath to variants file
+# param: (optional) integer number of lines per COPY, default= 100000
+# returns: number of variants loaded
+# throws: ValueError if a line is neither rsID nor variant name
+def load_input_variants( variants_file, batch_size=100000 ):
+    CURS.execute( 'DROP TABLE IF EXISTS input_variants' )
+    CURS.execute( '''CREATE TEMP TABLE input_variants 
+                     ( idx integer, input_type varchar, name varchar )''' )
+
+    idx = 0
+    buf = StringIO()
+    for input_type, name in iter_variants( variants_file ):
+        buf.write( '%d\t%s\t%s\n' % ( idx, input_type, name.replace( '\\', '\\\\' ) ) )
+        idx += 1
+
+        if idx % batch_size == 0:
+            buf.seek( 0 )
+            CURS.copy_from( buf, 'input_variants', columns=( 'idx', 'input_type', 'name' ) )
+            buf = StringIO()
+
+    buf.seek( 0 )
+    CURS.copy_from( buf, 'input_variants', columns=( 'idx', 'input_type', 'name' ) )
+    CURS.execute( 'ANALYZE input_variants' )
+
+    return idx
+
+
+# annotate a list of variants with one join per input type instead of 
+# one query per variant; output is in the same order as the input
+# param: string, filepath to variants file
+# param: list of features or None for all columns
+# yields: header, then 1 row per matching variant
+def bulk_annotate( variants_file, features ):
+    features = get_annotation_features( features )
+    with profile_phase( 'load input' ):
+        load_input_variants( variants_file )
+
+    columns = ', '.join( [ 'v.%s' % ( f ) for f in features ] )
+    sql = '''SELECT i.idx, {0} 
+             FROM input_variants i JOIN variant_annotation v ON v.rsid = i.name
+             WHERE i.input_type = 'rsid'
+             UNION ALL
+             SELECT i.idx, {0} 
+             FROM input_variants i JOIN variant_annotation v ON v.variant_name = i.name
+             WHERE i.input_type = 'variant_name'
+             ORDER BY 1'''.format( columns )
+
+    curs = get_server_cursor()
+    curs.execute( sql )
+    yield features
+    for row in ResultIter( curs, FETCH_SIZE ):
+        yield list( row[1:] )
+    curs.close()
+
+
+# numpy is only needed for snapshots
+# param: none
+# returns: annotation_snapshot module
+# throws: ValueError if numpy is not installed
+def get_snapshot_module():
+    try:
+        import annotation_snapshot
+    except ImportError, e:
+        raise ValueError( "snapshots need the numpy module: %s" % ( str( e ) ) )
+    return annotation_snapshot
+
+
+# dump variant_annotation into a local snapshot directory, see annotation_snapshot.py
+# param: string, snapshot directory
+# returns: number of rows exported
+# throws: ValueError if a column can't be stored in a snapshot
+def export_snapshot( directory ):
+    global META
+    annotation_snapshot = get_snapshot_module()
+
+    # the row count, string widths and rows must all come from one snapshot of the table
+    CONN.rollback()
+    CONN.set_session( isolation_level='REPEATABLE READ', readonly=True )
+    META = fetch_meta()
+
+    names = get_annotation_features( None )
+    types = get_column_types( names )
+
+    return annotation_snapshot.export_snapshot( directory, META, names, types, CURS, 
+                                                get_server_cursor(), validate_variant_name )
+
+
+# param: string, snapshot directory
+# returns: annotation_snapshot.Snapshot
+# throws: ValueError if directory is not a snapshot
+def open_snapshot( directory ):
+    annotation_snapshot = get_snapshot_module()
+    return annotation_snapshot.Snapshot( directory )
+
+
+# as annotate(), from a snapshot
+# param: annotation_snapshot.Snapshot
+# param: string, filepath to variants file
+# param: list of features or None for all columns
+# yields: header, then 1 row per matching variant
+def snapshot_annotate( snapshot, variants_file, features ):
+    features = get_annotation_features( features )
+
+    yield features
+    for row in snapshot.annotate( iter_variants( variants_file ), features ):
+        yield row
+
+
+# as get_variants(), from a snapshot
+# param: annotation_snapshot.Snapshot
+# param: where constraint in the form 'feature op value'
+# yields: header, then 1 row per variant passing the constraints
+def snapshot_get_variants( snapshot, wheres ):
+    feature_names, condition, vals = build_filter( wheres )
+    conditions = [ parse_where( where ) for where in wheres ]
+
+    yield feature_names
+    for row in snapshot.filter( conditions, feature_names ):
+        yield row
+
+
+# as get_region_variants(), from a snapshot
+# param: annotation_snapshot.Snapshot
+# param: list of merged regions, see get_regions()
+# param: list of where constraints in the form 'feature op value'
+# yields: header, then 1 row per variant
+def snapshot_get_region_variants( snapshot, regions, wheres ):
+    feature_names, condition, vals = build_filter( wheres )
+    conditions = [ parse_where( where ) for where in wheres ]
+
+    yield feature_names
+    for row in snapshot.region( regions, conditions, feature_names ):
+        yield row
 
-    return rows
         
 # formats None as 'NA', stringify other types
 def string_format( s ):
     if s is None:
         return 'NA'
     return str( s )
-                      
 
 
-#--------------------------------------------------------------------------------
-#--------------------------------------------------------------------------------
-#
-# main
-# 
-#--------------------------------------------------------------------------------
-#--------------------------------------------------------------------------------
+# rows may be a generator streaming from the db; write as they arrive
+# param: iterator of rows, header first
+# param: file handle
+# returns: number of rows written, not counting the header
+def write_tsv( rows, out_fh ):
+    n_rows = -1
+    for row in rows:
+        out_fh.write( '\t'.join( map( string_format, row ) ) + '\n' )
+        n_rows += 1
+    out_fh.flush()
+
+    return max( n_rows, 0 )
 
-try:
-    ARGS = parse_args()
-except ValueError, e:
-    sys.stderr.write( str( e ) )
-    sys.exit()
-    
-    
 
-db = 'functional_annotation'
-CONN, CURS = postgres_connect( db, ARGS.creds_file )
+# rows per record batch in the columnar formats
+COLUMN_BATCH_SIZE = 100000
+
+# param: list of output column names
+# returns: list of python types, 1 per column
+# throws: ValueError if a column has an unknown datatype
+def get_column_types( names ):
+    features = [ name for name in names if name not in ( 'variant_name', 'rsid' ) ]
+    feature2datatype = get_feature2datatype( features )
+
+    return [ feature2datatype.get( name, str ) for name in names ]
+
+
+# param: iterator of rows
+# param: integer number of rows per batch
+# yields: columns of the next batch, as a list of lists
+def column_batches( rows, batch_size ):
+    while True:
+        batch = list( itertools.islice( rows, batch_size ) )
+        if not batch:
+            break
+        yield [ list( column ) for column in zip( *batch ) ]
+
+
+# write rows as an Arrow IPC file or a Parquet file, 1 record batch at a time,
+# with each column in its native type
+# param: iterator of rows, header first
+# param: string, 'arrow' or 'parquet'
+# param: string, filepath to output file
+# returns: number of rows written
+# throws: ValueError if pyarrow is not installed
+def write_arrow( rows, fmt, outfile ):
+    try:
+        import pyarrow
+        if fmt == 'parquet':
+            import pyarrow.parquet
+    except ImportError:
+        raise ValueError( "--format %s needs the pyarrow module" % ( fmt ) )
+
+    type2arrow = { str:pyarrow.string(), int:pyarrow.int64(),
+                   float:pyarrow.float64(), bool:pyarrow.bool_() }
+
+    rows = iter( rows )
+    names = list( next( rows ) )
+    types = [ type2arrow[t] for t in get_column_types( names ) ]
+    schema = pyarrow.schema( [ pyarrow.field( name, t ) for name, t in zip( names, types ) ] )
+
+    if fmt == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter( outfile, schema )
+    else:
+        writer = pyarrow.RecordBatchFileWriter( outfile, schema )
+
+    n_rows = 0
+    for columns in column_batches( rows, COLUMN_BATCH_SIZE ):
+        arrays = [ pyarrow.array( column, type=t ) for column, t in zip( columns, types ) ]
+        batch = pyarrow.RecordBatch.from_arrays( arrays, names )
+        if fmt == 'parquet':
+            writer.write_table( pyarrow.Table.from_batches( [ batch ] ) )
+        else:
+            writer.write_batch( batch )
+        n_rows += batch.num_rows
+    writer.close()
+
+    return n_rows
+
+
+# write rows as a numpy .npz with 1 array per column, plus a boolean 
+# '<column>__null' array marking missing values; nulls are NaN in float 
+# columns, 0 or False in int and bool columns, '' in string columns.
+# the whole output is held in memory, as .npz can't be appended to
+# param: iterator of rows, header first
+# param: string, filepath to output file
+# returns: number of rows written
+# throws: ValueError if numpy is not installed
+def write_npz( rows, outfile ):
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError( "--format npz needs the numpy module" )
+
+    type2fill = { str:'', int:0, float:float( 'nan' ), bool:False }
+    type2dtype = { str:numpy.string_, int:numpy.int64, float:numpy.float64, bool:numpy.bool_ }
+
+    rows = iter( rows )
+    names = list( next( rows ) )
+    types = get_column_types( names )
+
+    chunks = [ [] for name in names ]
+    nulls = [ [] for name in names ]
+    for columns in column_batches( rows, COLUMN_BATCH_SIZE ):
+        for i, column in enumerate( columns ):
+            null = numpy.array( [ v is None for v in column ], dtype=numpy.bool_ )
+            fill = type2fill[types[i]]
+            values = [ fill if v is None else v for v in column ]
+            chunks[i].append( numpy.array( values, dtype=type2dtype[types[i]] ) )
+            nulls[i].append( null )
+
+    arrays = {}
+    for i, name in enumerate( names ):
+        if chunks[i]:
+            arrays[name] = numpy.concatenate( chunks[i] )
+            arrays[name + '__null'] = numpy.concatenate( nulls[i] )
+        else:
+            arrays[name] = numpy.array( [], dtype=type2dtype[types[i]] )
+            arrays[name + '__null'] = numpy.array( [], dtype=numpy.bool_ )
+
+    numpy.savez( outfile, **arrays )
+
+    return len( arrays[names[0]] )
+                      
+
+
+DB = 'functional_annotation'
+CONN, CURS = None, None
+# annotation_snapshot.Snapshot used instead of the db, if any
+SNAPSHOT = None
 SCHEMA = 'public'
 VAR_TABLE  = 'variant_annotation'
 SUMMARY_TABLE = 'variant_annotation_feature_summary'
 
-'''
-main actions:
-- get_features
-- describe_feature
-- get_variant_names, requires --rsid_list
-- get_rsids, requires --snp_name_list
-- filter_variants, requires --where
-'''
-# operator, how may I direct your call?
-try:
+# lines from the daemon starting with this byte carry the request status,
+# never output; output rows can't contain a NUL. the daemon first answers
+# ACCEPT or DECLINE, and after the output OK or ERROR
+DAEMON_STATUS = '\x00'
+# stdin of the request, if not sys.stdin; set by the daemon
+STDIN = None
+STDIN_BUFFER_SIZE = 1 << 20
+
+
+# param: string, path to credentials file
+# returns: default metadata cache file for the db in the credentials
+# throws: nothing
+def get_meta_cache_file( creds_file ):
+    user, pwd, port, host = get_creds( creds_file )
+    return os.path.join( os.path.expanduser( '~/.cache/annotation_db' ), 
+                         '%s_%s_%s.json' % ( host, port, DB ) )
+
+
+# param: string, path to credentials file
+# returns: string identifying the db the credentials connect to, host:port/db
+# throws: IOError if the credentials file can't be read
+def get_db_key( creds_file ):
+    user, pwd, port, host = get_creds( creds_file )
+    return '%s:%s/%s' % ( host, port, DB )
+
+
+# check that a unix socket path is a socket made by this user. another user 
+# could otherwise bind the default path first, read the requests sent to it
+# and answer them with made-up rows. in a sticky directory such as /tmp, a 
+# socket we own can't then be replaced by anyone else
+# param: string, socket path
+# returns: nothing
+# throws: OSError if the path does not exist, ValueError if it isn't our socket
+def check_socket_owner( path ):
+    st = os.lstat( path )
+    if not stat.S_ISSOCK( st.st_mode ):
+        raise ValueError( "%s is not a socket" % ( path ) )
+    if st.st_uid != os.getuid():
+        raise ValueError( "socket %s is owned by uid %d, not by this user" % ( path, st.st_uid ) )
+
+
+# run the requested action and write the output
+# param: argparse Namespace
+# param: file handle to which to write tsv output
+# returns: nothing
+# throws: ValueError, Exception on bad request
+def run( args, out_fh ):
+    if args.export_snapshot:
+        db_connect( args.creds_file )
+        n_rows = export_snapshot( args.export_snapshot )
+        sys.stderr.write( "exported %d variants to %s\n" % ( n_rows, args.export_snapshot ) )
+        return
+
+    if args.create_region_index:
+        db_connect( args.creds_file )
+        create_region_index()
+        return
+
+    if ( args.annotate or args.filter or args.aggregate ) and not args.snapshot:
+        db_connect( args.creds_file )
+
+    refresh_meta_if_stale( args )
     feature2meta = get_meta()
 
-    if ARGS.features:
-        for f in ARGS.features:
+    if args.features:
+        for f in args.features:
             if not f in feature2meta:
                 raise ValueError( 'unknown feature: %s' % ( f ) )
 
 
     rows = []
     # these can stand alone
-    if ARGS.describe_features is not None:
+    if args.describe_features is not None:
 
-        if len( ARGS.describe_features ) > 0:
-            names = ARGS.describe_features
+        if len( args.describe_features ) > 0:
+            names = args.describe_features
         else:
             names = feature2meta.keys()
 
@@ -560,26 +1661,197 @@ try:
             rows.append( [ feature, f_dtype, f_count, f_range ] )
 
 
-    elif ARGS.annotate:
-        rows = annotate( ARGS.variants_file, ARGS.features )
+    elif args.annotate:
+        if args.snapshot:
+            rows = snapshot_annotate( SNAPSHOT, args.variants_file, args.features )
+        elif args.bulk:
+            rows = bulk_annotate( args.variants_file, args.features )
+        else:
+            rows = annotate( args.variants_file, args.features )
+
+    elif args.aggregate:
+        if args.snapshot:
+            raise ValueError( "--aggregate runs in the db, it can't be used with --snapshot" )
+        regions = None
+        if args.region or args.bed_file:
+            regions = get_regions( args )
+        rows = aggregate( args.where or [], regions, args.features, args.quantiles, args.bins )
+
+    elif args.filter and ( args.region or args.bed_file ):
+        regions = get_regions( args )
+        if args.snapshot:
+            rows = snapshot_get_region_variants( SNAPSHOT, regions, args.where or [] )
+        else:
+            rows = get_region_variants( regions, args.where or [] )
+
+    elif args.filter:
+        if args.snapshot:
+            rows = snapshot_get_variants( SNAPSHOT, args.where )
+        elif args.workers > 1:
+            rows = parallel_get_variants( args.where, args.workers, args.creds_file )
+        else:
+            rows = get_variants( args.where )
 
-    elif ARGS.filter:
-        rows = get_variants( ARGS.where )
+    start = time.time()
+    if PROFILE is not None:
+        phase_time = get_phase_total()
 
-    if ARGS.outfile:
-        out_fh = open( ARGS.outfile, 'w' )
+    if args.format in ( 'arrow', 'parquet' ):
+        n_rows = write_arrow( rows, args.format, args.outfile )
+    elif args.format == 'npz':
+        n_rows = write_npz( rows, args.outfile )
     else:
-        out_fh = sys.stdout
+        n_rows = write_tsv( rows, out_fh )
 
-    for row in rows:
-        out_fh.write( '\t'.join( map( string_format, row ) ) + '\n' )
+    if PROFILE is not None:
+        PROFILE['rows_written'] += n_rows
+        # rows are fetched as they are written; what isn't query, fetch or validation is writing
+        add_phase_time( 'write', time.time() - start - ( get_phase_total() - phase_time ) )
 
-        
 
-# error catcher
-except Exception, e:
-    if ARGS.debug:
-        traceback.print_exc()
-    sys.stderr.write( "Error: %s\n" % ( str( e ) ) )
-    sys.exit( 1 )
+# send the request to annotation_daemon.py over its unix socket and copy 
+# the daemon's output to out_fh
+# param: argparse Namespace
+# param: file handle to which to write output
+# returns: True if the daemon handled the request, False if no daemon is listening
+# throws: ValueError with the daemon's message if the request failed
+def forward_to_daemon( args, out_fh ):
+    try:
+        check_socket_owner( args.socket )
+    except OSError:
+        return False
+    except ValueError, e:
+        sys.stderr.write( "Warning: not using the annotation daemon: %s\n" % ( str( e ) ) )
+        return False
+
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        sock.connect( args.socket )
+    except socket.error:
+        sock.close()
+        return False
+
+    # the daemon reads files itself, so paths must not depend on our cwd
+    request = dict( vars( args ) )
+    for name in [ 'variants_file', 'bed_file' ]:
+        if request[name] and not ( name == 'variants_file' and is_stdin( request[name] ) ):
+            request[name] = os.path.abspath( request[name] )
+
+    # the daemon only answers for the db it is connected to
+    try:
+        request['db_key'] = get_db_key( args.creds_file )
+    except IOError:
+        request['db_key'] = None
+
+    sock.sendall( json.dumps( request ) + '\n' )
+
+    # nothing is sent or written until the daemon accepts the request, so a
+    # declined one can still be run here
+    fh = sock.makefile( 'rb' )
+    fields = fh.readline()[1:].rstrip( '\n' ).split( '\t', 1 )
+    if fields[0] != 'ACCEPT':
+        fh.close()
+        sock.close()
+        if fields[0] == 'ERROR':
+            raise ValueError( fields[-1] )
+        if args.debug:
+            sys.stderr.write( "annotation daemon declined the request: %s\n" % ( fields[-1] ) )
+        return False
 
+    # stdin follows the request on the socket. it is sent from a thread, since
+    # the daemon may write output before it has read all the input
+    def send_stdin():
+        try:
+            while True:
+                data = os.read( sys.stdin.fileno(), STDIN_BUFFER_SIZE )
+                if not data: break
+                sock.sendall( data )
+            sock.shutdown( socket.SHUT_WR )
+        except socket.error:
+            # the daemon stopped reading, eg on an error it will report
+            pass
+
+    sender = None
+    if args.variants_file and is_stdin( args.variants_file ):
+        sender = threading.Thread( target=send_stdin )
+        sender.daemon = True
+        sender.start()
+    else:
+        sock.shutdown( socket.SHUT_WR )
+
+    for line in fh:
+        if line.startswith( DAEMON_STATUS ):
+            fields = line[1:].rstrip( '\n' ).split( '\t', 1 )
+            fh.close()
+            sock.close()
+            if fields[0] != 'OK':
+                raise ValueError( fields[-1] )
+            out_fh.flush()
+            return True
+        out_fh.write( line )
+
+    raise ValueError( 'annotation daemon closed the connection before finishing' )
+
+
+#--------------------------------------------------------------------------------
+#--------------------------------------------------------------------------------
+#
+# main
+# 
+#--------------------------------------------------------------------------------
+#--------------------------------------------------------------------------------
+
+'''
+main actions:
+- get_features
+- describe_feature
+- get_variant_names, requires --rsid_list
+- get_rsids, requires --snp_name_list
+- filter_variants, requires --where
+'''
+if __name__ == '__main__':
+    try:
+        ARGS = parse_args()
+    except ValueError, e:
+        sys.stderr.write( str( e ) )
+        sys.exit()
+
+    # operator, how may I direct your call?
+    try:
+        if ARGS.format != 'tsv':
+            out_fh = None
+        elif ARGS.outfile:
+            out_fh = open( ARGS.outfile, 'w' )
+        else:
+            out_fh = sys.stdout
+
+        # the daemon only speaks tsv, and snapshots are local
+        use_daemon = not ( ARGS.no_daemon or ARGS.format != 'tsv' or ARGS.profile or
+                           ARGS.snapshot or ARGS.export_snapshot or ARGS.create_region_index )
+        if use_daemon and forward_to_daemon( ARGS, out_fh ):
+            sys.exit( 0 )
+
+        if ARGS.profile:
+            start_profile()
+
+        with profile_phase( 'meta' ):
+            if ARGS.snapshot:
+                SNAPSHOT = open_snapshot( ARGS.snapshot )
+                META = SNAPSHOT.meta
+            else:
+                if not ARGS.meta_cache:
+                    ARGS.meta_cache = get_meta_cache_file( ARGS.creds_file )
+                META = load_meta( ARGS.meta_cache, ARGS.meta_cache_max_age, ARGS.creds_file, 
+                                  ARGS.refresh_meta )
+
+        run( ARGS, out_fh )
+
+        if ARGS.profile:
+            print_profile( ARGS.profile_json )
+
+    # error catcher
+    except Exception, e:
+        if ARGS.debug:
+            traceback.print_exc()
+        sys.stderr.write( "Error: %s\n" % ( str( e ) ) )
+        sys.exit( 1 )
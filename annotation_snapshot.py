@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+
+# Offline, memory-mapped columnar snapshot of the variant_annotation table.
+# Written by annotation_db.py --export_snapshot, queried by annotation_db.py --snapshot.
+#
+# A snapshot is a directory with
+#   meta.json                   feature metadata in the layout of the annotation_db.py
+#                               metadata cache, plus the snapshot's columns and types
+#   <column>.npy                1 typed array per column, rows sorted by position
+#   <column>.null.npy           boolean array marking missing values
+#   position.npy                sorted int64 key, chromosome << 32 | position
+#   <column>.sorted.npy         variant_name and rsid sorted, for binary search,
+#   <column>.order.npy          and the row of each sorted entry
+
+import os
+import sys
+import json
+
+import numpy
+
+
+SNAPSHOT_VERSION = 1
+
+# rows fetched per round trip during export
+FETCH_SIZE = 10000
+# rows per vectorized filter scan
+SCAN_SIZE = 1000000
+# variants per batched binary search
+LOOKUP_SIZE = 100000
+
+TYPE2NAME = { str:'str', int:'int', float:'float', bool:'bool' }
+NAME2TYPE = dict( [ ( v, k ) for k, v in TYPE2NAME.items() ] )
+TYPE2FILL = { str:'', int:0, float:float( 'nan' ), bool:False }
+
+# postgres spellings of boolean literals
+TRUE_STRINGS = set( [ 'true', 't', 'yes', 'y', 'on', '1' ] )
+
+
+# param: python type of column
+# param: (optional) integer max string length
+# returns: numpy dtype for column
+def get_dtype( datatype, width=None ):
+    if datatype is str:
+        return numpy.dtype( 'S%d' % ( max( width or 0, 1 ) ) )
+    elif datatype is int:
+        return numpy.dtype( numpy.int64 )
+    elif datatype is float:
+        return numpy.dtype( numpy.float64 )
+    elif datatype is bool:
+        return numpy.dtype( numpy.bool_ )
+    raise ValueError( "no snapshot datatype for %s" % ( datatype ) )
+
+
+# param: string, variant name
+# param: function returning ( chrom, pos ) for a variant name,
+#        throwing ValueError if the name is badly formed
+# returns: integer sort key, chromosome << 32 | position; 0 if badly formed
+def get_position_key( variant_name, position ):
+    try:
+        chrom, pos = position( variant_name )
+        return ( int( chrom ) << 32 ) | int( pos )
+    except ValueError:
+        return 0
+
+
+# dump variant_annotation into a snapshot directory. the caller should run this
+# in a repeatable read transaction so the count and the rows agree
+# param: string, snapshot directory
+# param: metadata dict, see annotation_db.fetch_meta()
+# param: list of column names to export
+# param: list of python types, 1 per column
+# param: db cursor
+# param: named db cursor, for streaming the table
+# param: function returning ( chrom, pos ) for a variant name
+# returns: number of rows exported
+# throws: ValueError if a column has no snapshot datatype
+def export_snapshot( directory, meta, names, types, curs, server_curs, position ):
+    if not os.path.isdir( directory ):
+        os.makedirs( directory )
+
+    curs.execute( 'SELECT COUNT(*) FROM variant_annotation' )
+    n_rows = curs.fetchone()[0]
+
+    # strings are stored fixed width, so find the widest value first. the
+    # values arrive as utf-8 bytes, so the width is in bytes, not characters
+    widths = {}
+    str_names = [ name for name, t in zip( names, types ) if t is str ]
+    if str_names:
+        sql = 'SELECT %s FROM variant_annotation' % ( ', '.join( [ 'MAX( OCTET_LENGTH( %s ) )' % ( name )
+                                                                    for name in str_names ] ) )
+        curs.execute( sql )
+        widths = dict( zip( str_names, curs.fetchone() ) )
+
+    # fill unsorted memory-mapped columns in id order
+    dtypes = [ get_dtype( t, widths.get( name ) ) for name, t in zip( names, types ) ]
+    values = []
+    nulls = []
+    for name, dtype in zip( names, dtypes ):
+        path = os.path.join( directory, '%s.unsorted.npy' % ( name ) )
+        values.append( numpy.lib.format.open_memmap( path, 'w+', dtype, ( n_rows, ) ) )
+        path = os.path.join( directory, '%s.null.unsorted.npy' % ( name ) )
+        nulls.append( numpy.lib.format.open_memmap( path, 'w+', numpy.bool_, ( n_rows, ) ) )
+
+    server_curs.execute( 'SELECT %s FROM variant_annotation ORDER BY id' % ( ', '.join( names ) ) )
+    start = 0
+    while True:
+        batch = server_curs.fetchmany( FETCH_SIZE )
+        if not batch:
+            break
+        end = start + len( batch )
+        for c, column in enumerate( zip( *batch ) ):
+            fill = TYPE2FILL[types[c]]
+            values[c][start:end] = [ fill if v is None else v for v in column ]
+            nulls[c][start:end] = [ v is None for v in column ]
+        start = end
+    server_curs.close()
+
+    # sort rows by position, then name
+    variant_names = values[names.index( 'variant_name' )]
+    keys = numpy.zeros( n_rows, dtype=numpy.int64 )
+    for start in range( 0, n_rows, SCAN_SIZE ):
+        chunk = variant_names[start:start + SCAN_SIZE].tolist()
+        keys[start:start + len( chunk )] = [ get_position_key( name, position ) for name in chunk ]
+    order = numpy.lexsort( ( variant_names, keys ) )
+    numpy.save( os.path.join( directory, 'position.npy' ), keys[order] )
+    del keys
+
+    for name, column, null in zip( names, values, nulls ):
+        numpy.save( os.path.join( directory, '%s.npy' % ( name ) ), column[order] )
+        numpy.save( os.path.join( directory, '%s.null.npy' % ( name ) ), null[order] )
+    del values, nulls, variant_names
+    for name in names:
+        os.unlink( os.path.join( directory, '%s.unsorted.npy' % ( name ) ) )
+        os.unlink( os.path.join( directory, '%s.null.unsorted.npy' % ( name ) ) )
+
+    # lookup indexes
+    for name in [ 'variant_name', 'rsid' ]:
+        column = numpy.load( os.path.join( directory, '%s.npy' % ( name ) ), mmap_mode='r' )
+        order = numpy.argsort( column, kind='mergesort' )
+        numpy.save( os.path.join( directory, '%s.order.npy' % ( name ) ), order )
+        numpy.save( os.path.join( directory, '%s.sorted.npy' % ( name ) ), column[order] )
+
+    # written last; a snapshot without meta.json is incomplete
+    meta = dict( meta )
+    meta['snapshot_version'] = SNAPSHOT_VERSION
+    meta['n_rows'] = n_rows
+    meta['names'] = names
+    meta['types'] = [ TYPE2NAME[t] for t in types ]
+    fh = open( os.path.join( directory, 'meta.json' ), 'w' )
+    json.dump( meta, fh )
+    fh.close()
+
+    return n_rows
+
+
+
+class Snapshot( object ):
+
+    # param: string, snapshot directory
+    # throws: ValueError if the directory is not a complete snapshot of this version
+    def __init__( self, directory ):
+        meta_file = os.path.join( directory, 'meta.json' )
+        if not os.path.isfile( meta_file ):
+            raise ValueError( "not a snapshot directory: %s" % ( directory ) )
+
+        fh = open( meta_file )
+        self.meta = json.load( fh )
+        fh.close()
+
+        if self.meta.get( 'snapshot_version' ) != SNAPSHOT_VERSION:
+            raise ValueError( "snapshot %s has version %s, expected %s" % ( directory,
+                                                                          self.meta.get( 'snapshot_version' ),
+                                                                          SNAPSHOT_VERSION ) )
+        self.directory = directory
+        self.n_rows = self.meta['n_rows']
+        self.name2type = dict( zip( self.meta['names'],
+                                    [ NAME2TYPE[t] for t in self.meta['types'] ] ) )
+        self.arrays = {}
+
+
+    # param: string, file name in the snapshot directory, without .npy
+    # returns: memory-mapped array
+    def load( self, name ):
+        if not name in self.arrays:
+            path = os.path.join( self.directory, '%s.npy' % ( name ) )
+            if not os.path.isfile( path ):
+                raise ValueError( "column not in snapshot: %s" % ( name ) )
+            self.arrays[name] = numpy.load( path, mmap_mode='r' )
+        return self.arrays[name]
+
+
+    # param: string, column name
+    # returns: tuple of values array, null array
+    def column( self, name ):
+        return ( self.load( name ), self.load( name + '.null' ) )
+
+
+    # param: array of row numbers
+    # param: list of column names
+    # returns: list of rows, with python values and None for nulls, as the db returns them
+    def rows( self, idx, names ):
+        columns = []
+        for name in names:
+            values, nulls = self.column( name )
+            column = values[idx].tolist()
+            for i in numpy.flatnonzero( nulls[idx] ):
+                column[i] = None
+            columns.append( column )
+
+        return [ list( row ) for row in zip( *columns ) ]
+
+
+    # param: string, 'variant_name' or 'rsid'
+    # param: list of string keys
+    # returns: list of arrays of matching row numbers, 1 per key, in position order
+    def lookup( self, name, keys ):
+        sorted_values = self.load( name + '.sorted' )
+        order = self.load( name + '.order' )
+        width = sorted_values.dtype.itemsize
+
+        # a key wider than the column can't match, and would be truncated by the cast
+        fits = numpy.array( [ len( key ) <= width for key in keys ], dtype=numpy.bool_ )
+        keys = numpy.array( [ key if ok else '' for key, ok in zip( keys, fits ) ],
+                            dtype=sorted_values.dtype )
+        lo = numpy.searchsorted( sorted_values, keys, 'left' )
+        hi = numpy.searchsorted( sorted_values, keys, 'right' )
+
+        matches = []
+        for i in range( len( keys ) ):
+            if fits[i] and hi[i] > lo[i]:
+                matches.append( numpy.sort( order[lo[i]:hi[i]] ) )
+            else:
+                matches.append( numpy.array( [], dtype=numpy.int64 ) )
+
+        return matches
+
+
+    # param: iterator of ( input_type, name ), input_type is 'variant_name' or 'rsid'
+    # param: list of output column names
+    # yields: 1 row per matching variant, in input order
+    def annotate( self, inputs, names ):
+        inputs = iter( inputs )
+        while True:
+            batch = []
+            for item in inputs:
+                batch.append( item )
+                if len( batch ) == LOOKUP_SIZE:
+                    break
+            if not batch:
+                break
+
+            matches = [ None ] * len( batch )
+            for input_type in [ 'variant_name', 'rsid' ]:
+                positions = [ i for i, item in enumerate( batch ) if item[0] == input_type ]
+                if not positions:
+                    continue
+                found = self.lookup( input_type, [ batch[i][1] for i in positions ] )
+                for i, rows in zip( positions, found ):
+                    matches[i] = rows
+
+            idx = numpy.concatenate( matches )
+            if len( idx ):
+                for row in self.rows( idx, names ):
+                    yield row
+
+
+    # param: string, column name
+    # param: string, value from a where constraint
+    # returns: value as the column's python type
+    def convert( self, name, value ):
+        datatype = self.name2type[name]
+        if datatype is bool:
+            return value.lower() in TRUE_STRINGS
+        return datatype( value )
+
+
+    # param: list of ( feature, op, values ), see annotation_db.parse_where()
+    # param: integer first row
+    # param: integer end row
+    # returns: boolean array, rows in [start, end) passing all conditions
+    def scan( self, conditions, start, end ):
+        mask = numpy.ones( end - start, dtype=numpy.bool_ )
+        for feature, op, values in conditions:
+            column, nulls = self.column( feature )
+            column = column[start:end]
+
+            # as in sql, a null never passes a comparison
+            passed = numpy.zeros( end - start, dtype=numpy.bool_ )
+            for value in values:
+                value = self.convert( feature, value )
+                if op == 'lt':
+                    passed |= column < value
+                elif op == 'gt':
+                    passed |= column > value
+                else:
+                    passed |= column == value
+            mask &= passed
+            mask &= ~nulls[start:end]
+
+        return mask
+
+
+    # param: list of ( feature, op, values ), see annotation_db.parse_where()
+    # param: list of output column names
+    # yields: 1 row per variant passing all conditions, in position order
+    def filter( self, conditions, names ):
+        for start in range( 0, self.n_rows, SCAN_SIZE ):
+            end = min( start + SCAN_SIZE, self.n_rows )
+            idx = numpy.flatnonzero( self.scan( conditions, start, end ) ) + start
+            if len( idx ):
+                for row in self.rows( idx, names ):
+                    yield row
+
+
+    # param: list of merged ( chromosome code, start, end ), see annotation_db.get_regions()
+    # param: list of ( feature, op, values ), see annotation_db.parse_where()
+    # param: list of output column names
+    # yields: 1 row per variant in the regions passing all conditions, in position order
+    def region( self, regions, conditions, names ):
+        positions = self.load( 'position' )
+        for chrom, start, end in regions:
+            lo = int( numpy.searchsorted( positions, ( chrom << 32 ) | start, 'left' ) )
+            hi = int( numpy.searchsorted( positions, ( chrom << 32 ) | end, 'right' ) )
+            for scan_start in range( lo, hi, SCAN_SIZE ):
+                scan_end = min( scan_start + SCAN_SIZE, hi )
+                idx = numpy.flatnonzero( self.scan( conditions, scan_start, scan_end ) ) + scan_start
+                if len( idx ):
+                    for row in self.rows( idx, names ):
+                        yield row
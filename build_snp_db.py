@@ -0,0 +1,389 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import sqlite3
+import argparse
+import subprocess
+import textwrap
+
+import snp2rsID
+
+
+# builds the sqlite3 dbs read by snp2rsID.py
+# input: UCSC snpNNN table dump, dbSNP RsMergeArch.bcp
+# output: dbsnp and rs_merge sqlite3 dbs, and a query plan report
+
+
+# columns of the UCSC snpNNN tables, snp132 and later
+SNP_COLUMNS = [ 'bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand',
+                'refNCBI', 'refUCSC', 'observed', 'molType', 'class', 'valid', 'avHet',
+                'avHetSE', 'func', 'locType', 'weight', 'exceptions', 'submitterCount',
+                'submitters', 'alleleFreqCount', 'alleles', 'alleleNs', 'alleleFreqs',
+                'bitfields' ]
+
+# columns of dbSNP RsMergeArch.bcp
+MERGE_COLUMNS = [ 'rsHigh', 'rsLow', 'build', 'orien', 'created', 'updated',
+                  'rsCurrent', 'orien2Current', 'comment' ]
+
+# rows per executemany call
+BATCH_SIZE = 100000
+
+# pragmas for the build only; a half-built db is thrown away, so no journal
+BUILD_PRAGMAS = [ 'PRAGMA journal_mode = OFF',
+                  'PRAGMA synchronous = OFF',
+                  'PRAGMA locking_mode = EXCLUSIVE',
+                  'PRAGMA temp_store = MEMORY',
+                  'PRAGMA cache_size = -524288' ]
+
+# rsIDs are stored as integers, see snp2rsID.rsid2int(). the table is clustered
+# on its key, so an rsid lookup reads the row itself, with no separate index.
+# an rsID may map to several locations, hence the position in the key.
+SNP_SCHEMA = '''CREATE TABLE dbsnp ( rsid INTEGER, chrom TEXT, chromStart INTEGER,
+                                     chromEnd INTEGER, alleles TEXT, class TEXT,
+                                     PRIMARY KEY ( rsid, chrom, chromStart, chromEnd ) )
+                WITHOUT ROWID'''
+
+# covering index for the position query shapes in snp2rsID.prep_input():
+#   chrom_pos: chrom = ? AND chromEnd = ?
+#   snp_name:  chrom = ? AND chromStart = ? AND chromEnd = ?
+# chromEnd goes before chromStart so one index serves both; rsid comes along
+# as part of the primary key
+SNP_INDEXES = [ '''CREATE INDEX dbsnp_chrom_pos
+                   ON dbsnp ( chrom, chromEnd, chromStart, alleles )''' ]
+
+# rsHigh, the retired rsID, is the integer key
+MERGE_SCHEMA = '''CREATE TABLE rs_merge ( rsHigh INTEGER PRIMARY KEY, rsLow INTEGER,
+                                          build INTEGER, orien INTEGER, created TEXT,
+                                          updated TEXT, rsCurrent INTEGER,
+                                          orien2Current INTEGER, comment TEXT )
+                  WITHOUT ROWID'''
+
+MERGE_INDEXES = [ 'CREATE INDEX rs_merge_rsLow ON rs_merge ( rsLow, rsCurrent )' ]
+
+# every retired rsID mapped to the rsID it is now part of, after following
+# all merges, so a lookup is a single key search
+RS_CURRENT_SCHEMA = '''CREATE TABLE rs_current ( rsid INTEGER PRIMARY KEY, rsCurrent INTEGER )
+                       WITHOUT ROWID'''
+
+# each pass follows one more merge; chains in dbSNP are a few merges long
+MAX_MERGE_PASSES = 64
+
+
+################################################################################
+#
+# parse_args()
+# param: none
+# return: argparse Namespace object
+#
+################################################################################
+def parse_args():
+    parser = argparse.ArgumentParser( formatter_class=argparse.RawDescriptionHelpFormatter,
+                                      description=textwrap.dedent('''\
+This program builds the sqlite3 dbs used by snp2rsID.py. The dbsnp table is loaded from
+a UCSC snpNNN table dump, eg snp150.txt.gz, and the rs_merge table from dbSNP's
+RsMergeArch.bcp.gz. Either db can be built on its own. Each query snp2rsID.py runs is
+then checked with EXPLAIN QUERY PLAN, and the program exits non-zero if any of them
+would scan a table instead of using an index.''' ))
+
+    parser.add_argument( '--snp_table', help='UCSC snpNNN table dump, optionally gzipped' )
+    parser.add_argument( '--merge_table', help='dbSNP RsMergeArch.bcp, optionally gzipped' )
+    parser.add_argument( '--snp_db', help='path of dbSNP sqlite3 db to write or check' )
+    parser.add_argument( '--merge_db', help='path of dbSNP sqlite3 merge db to write or check' )
+    parser.add_argument( '--batch_size', type=int, default=BATCH_SIZE,
+                         help='rows per insert batch, defaults to %d' % ( BATCH_SIZE ) )
+    parser.add_argument( '--report_only', action='store_true',
+                         help='only print the query plan report for existing dbs' )
+    args = parser.parse_args()
+
+    if args.snp_table and not args.snp_db:
+        parser.error( '--snp_table requires --snp_db' )
+    if args.merge_table and not args.merge_db:
+        parser.error( '--merge_table requires --merge_db' )
+    if args.report_only and ( args.snp_table or args.merge_table ):
+        parser.error( '--report_only does not build, drop --snp_table and --merge_table' )
+    if not args.snp_db and not args.merge_db:
+        parser.error( 'specify --snp_db and/or --merge_db' )
+
+    return args
+
+
+
+
+################################################################################
+#
+# iter_table_rows()
+# param: string; path of tab-separated dump, optionally gzipped
+# return: iterator of lists of fields
+#
+################################################################################
+def iter_table_rows( filename ):
+    proc = None
+    if filename.endswith( '.gz' ):
+        # gzip in a separate process is much faster than the gzip module
+        proc = subprocess.Popen( [ 'gzip', '-dc', filename ], stdout=subprocess.PIPE,
+                                 bufsize=1<<20 )
+        fh = proc.stdout
+    else:
+        fh = open( filename, 'rb', 1<<20 )
+
+    for line in fh:
+        yield line.rstrip( '\r\n' ).split( '\t' )
+    fh.close()
+
+    if proc is not None and proc.wait() != 0:
+        raise ValueError( "failed to decompress '%s'" % ( filename ) )
+
+
+
+################################################################################
+#
+# iter_snp_rows()
+# param: string; path of UCSC snpNNN dump
+# return: iterator of dbsnp rows
+#
+################################################################################
+def iter_snp_rows( filename ):
+    cols = [ SNP_COLUMNS.index( c ) for c in
+             ( 'name', 'chrom', 'chromStart', 'chromEnd', 'alleles', 'class' ) ]
+    name, chrom, start, end, alleles, snp_class = cols
+
+    for fields in iter_table_rows( filename ):
+        if len( fields ) < len( SNP_COLUMNS ):
+            raise ValueError( "'%s' does not look like a UCSC snpNNN table, "
+                              "expected %d columns, got %d" % ( filename, len( SNP_COLUMNS ),
+                                                                len( fields ) ) )
+        rsid = snp2rsID.rsid2int( fields[name] )
+        if rsid is None:
+            raise ValueError( "'%s' is not an rsID in '%s'" % ( fields[name], filename ) )
+
+        yield ( rsid, fields[chrom], int( fields[start] ), int( fields[end] ),
+                fields[alleles], fields[snp_class] )
+
+
+
+################################################################################
+#
+# iter_merge_rows()
+# param: string; path of RsMergeArch.bcp
+# return: iterator of rs_merge rows
+#
+################################################################################
+def iter_merge_rows( filename ):
+    n_columns = len( MERGE_COLUMNS )
+
+    for fields in iter_table_rows( filename ):
+        if len( fields ) < n_columns:
+            raise ValueError( "'%s' does not look like RsMergeArch, "
+                              "expected %d columns, got %d" % ( filename, n_columns,
+                                                                len( fields ) ) )
+        fields = [ f if f != '' else None for f in fields[:n_columns] ]
+        yield fields
+
+
+
+################################################################################
+#
+# build_db()
+# load rows into a new db, then index and analyze it. the db is built under a
+# temporary name and renamed at the end, so a failed build never replaces a
+# good db.
+# param: string; path of db to write
+# param: string; CREATE TABLE statement
+# param: list of CREATE INDEX statements
+# param: string; table name
+# param: iterator of rows
+# param: int; rows per executemany
+# param: function of sqlite3 cursor, run after indexing, before ANALYZE
+# return: int; number of rows loaded
+#
+################################################################################
+def build_db( db, schema, indexes, table, rows, batch_size, finish=None ):
+    tmp_db = db + '.tmp'
+    if os.path.exists( tmp_db ):
+        os.unlink( tmp_db )
+
+    conn = sqlite3.connect( tmp_db )
+    curs = conn.cursor()
+    for pragma in BUILD_PRAGMAS:
+        curs.execute( pragma )
+
+    curs.execute( schema )
+
+    # indexes are built after loading; one sort is far cheaper than
+    # maintaining the b-trees row by row
+    n_columns = len( curs.execute( 'SELECT * FROM %s' % ( table ) ).description )
+    sql = 'INSERT OR REPLACE INTO %s VALUES ( %s )' % ( table, ', '.join( [ '?' ] * n_columns ) )
+
+    n = 0
+    batch = []
+    for row in rows:
+        batch.append( row )
+        if len( batch ) >= batch_size:
+            curs.executemany( sql, batch )
+            n += len( batch )
+            batch = []
+            sys.stderr.write( '\r%s: %d rows' % ( table, n ) )
+    if batch:
+        curs.executemany( sql, batch )
+        n += len( batch )
+    sys.stderr.write( '\r%s: %d rows\n' % ( table, n ) )
+
+    for index in indexes:
+        sys.stderr.write( '%s\n' % ( ' '.join( index.split() ) ) )
+        curs.execute( index )
+
+    if finish is not None:
+        finish( curs )
+
+    curs.execute( 'ANALYZE' )
+    conn.commit()
+    conn.close()
+
+    os.rename( tmp_db, db )
+
+    return n
+
+
+
+################################################################################
+#
+# build_rs_current()
+# fill rs_current with the transitive closure of rs_merge. starts from the
+# rsCurrent dbSNP gave each retired rsID, then repeatedly replaces any
+# rsCurrent that was itself retired later, until nothing changes.
+# param: sqlite3 cursor of the merge db
+# return: nothing
+#
+################################################################################
+def build_rs_current( curs ):
+    curs.execute( RS_CURRENT_SCHEMA )
+    curs.execute( '''INSERT INTO rs_current
+                     SELECT rsHigh, COALESCE( rsCurrent, rsLow ) FROM rs_merge
+                     WHERE COALESCE( rsCurrent, rsLow ) != rsHigh''' )
+
+    for n_pass in range( MAX_MERGE_PASSES ):
+        curs.execute( '''UPDATE rs_current
+                         SET rsCurrent = ( SELECT n.rsCurrent FROM rs_current n
+                                           WHERE n.rsid = rs_current.rsCurrent )
+                         WHERE EXISTS ( SELECT 1 FROM rs_current n
+                                        WHERE n.rsid = rs_current.rsCurrent
+                                          AND n.rsCurrent != rs_current.rsCurrent )''' )
+        if curs.rowcount == 0: break
+        sys.stderr.write( 'rs_current: pass %d, %d rsIDs moved along a merge\n' % (
+            n_pass + 1, curs.rowcount ) )
+    else:
+        # only a cycle of merges can still be moving
+        sys.stderr.write( 'Warning: %d rsIDs still not resolved after %d passes, '
+                          'rs_merge may contain cycles\n' % ( curs.rowcount,
+                                                                MAX_MERGE_PASSES ) )
+
+    # a merge cycle can leave an rsID merged into itself
+    curs.execute( 'DELETE FROM rs_current WHERE rsid = rsCurrent' )
+
+
+
+################################################################################
+#
+# get_query_shapes()
+# the queries snp2rsID.py runs, with example parameters
+# param: boolean; dbsnp has integer rsids
+# return: list of tuples; label, db key, sql, params
+#
+################################################################################
+def get_query_shapes( int_rsid=True ):
+    shapes = []
+    for input_type, elem in [ ( 'snp_name', '1:1234_C/T' ),
+                              ( 'chrom_pos', '1:1234' ),
+                              ( 'rsid', 'rs1234' ) ]:
+        sql, params = snp2rsID.prep_input( elem, input_type, int_rsid=int_rsid )
+        shapes.append( ( input_type, 'snp_db', sql, params ) )
+
+    sql, params = snp2rsID.prep_input( 'rs1234', 'rsid', get_class=True, int_rsid=int_rsid )
+    shapes.append( ( 'rsid --get_class', 'snp_db', sql, params ) )
+    shapes.append( ( 'rsid merge', 'merge_db', snp2rsID.MERGE_SQL, [ 1234, 1234 ] ) )
+    shapes.append( ( 'rsid rs_current', 'merge_db', snp2rsID.RS_CURRENT_SQL, [ 1234 ] ) )
+
+    return shapes
+
+
+
+################################################################################
+#
+# report_query_plans()
+# print EXPLAIN QUERY PLAN for each query shape
+# param: args
+# return: boolean; True if every query uses an index
+#
+################################################################################
+def report_query_plans( args ):
+    all_indexed = True
+
+    for db in ( args.snp_db, args.merge_db ):
+        if db and not os.path.isfile( db ):
+            sys.stderr.write( "sqlite3 database '%s' not found\n" % ( db ) )
+            return False
+
+    # dbs from before integer rsids are still checked, with their own queries
+    int_rsid = True
+    if args.snp_db:
+        conn = sqlite3.connect( args.snp_db )
+        int_rsid = snp2rsID.has_int_rsids( conn.cursor() )
+        conn.close()
+
+    for label, db_key, sql, params in get_query_shapes( int_rsid ):
+        db = getattr( args, db_key )
+        if not db: continue
+
+        conn = sqlite3.connect( db )
+        try:
+            plan = [ row[-1] for row in conn.execute( 'EXPLAIN QUERY PLAN ' + sql, params ) ]
+        except sqlite3.OperationalError, e:
+            # eg no rs_current in a merge db built before it existed
+            print '# %s: skipped, %s' % ( label, str( e ) )
+            continue
+        finally:
+            conn.close()
+
+        # a SCAN reads every row of the table or index, a SEARCH probes it
+        indexed = True
+        for detail in plan:
+            if detail.startswith( 'SCAN' ):
+                indexed = False
+        all_indexed = all_indexed and indexed
+
+        print '# %s: %s' % ( label, 'indexed' if indexed else 'NOT INDEXED' )
+        print '  %s' % ( ' '.join( sql.split() ) )
+        for detail in plan:
+            print '    %s' % ( detail )
+
+    return all_indexed
+
+
+
+
+################################################################################
+################################################################################
+##
+## main
+##
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    try:
+        if args.snp_table:
+            build_db( args.snp_db, SNP_SCHEMA, SNP_INDEXES, 'dbsnp',
+                      iter_snp_rows( args.snp_table ), args.batch_size )
+        if args.merge_table:
+            build_db( args.merge_db, MERGE_SCHEMA, MERGE_INDEXES, 'rs_merge',
+                      iter_merge_rows( args.merge_table ), args.batch_size,
+                      finish=build_rs_current )
+    except ( IOError, ValueError ), e:
+        sys.stderr.write( 'Error: %s\n' % ( str( e ) ) )
+        sys.exit( 1 )
+
+    if not report_query_plans( args ):
+        sys.exit( 1 )
@@ -4,7 +4,8 @@ import os
 import sys
 import sqlite3
 import argparse
-import select
+import itertools
+import tempfile
 import textwrap
 
 from collections import defaultdict
@@ -31,7 +32,9 @@ the original input, current rsid, chromosome, and start position, end position,
 The start position is 0-based, and the end position is 1-based, as in a bedfile.
 When the query is rsID or snp_name, it can be taken from STDIN or a whitespace-separated file. 
 When the query is chromosome and position, it must be read from a file. The relevant columns 
-can be specified if different from the default.''' ))
+can be specified if different from the default.
+Inputs are read and looked up in chunks, and results are printed as they are found.
+Identifiers that were not found are listed at the end, or written to --not_found_file.''' ))
                                       
                                       
     parser.add_argument( '-i', '--input_type', required=True,
@@ -51,9 +54,20 @@ can be specified if different from the default.''' ))
     
     parser.add_argument( '--get_class', action='store_true', 
                          help='when input is rsid, get snp class eg single, deletion' )
+    parser.add_argument( '--batch', action='store_true',
+                         help='''load each chunk of inputs into a temp table and look them up with
+                                 one join, instead of one query per input; faster for large inputs''' )
+    parser.add_argument( '--chunk_size', type=int, default=10000,
+                         help='number of inputs read and looked up at a time, defaults to 10000' )
+    parser.add_argument( '--not_found_file',
+                         help='''write identifiers that were not found to this file, instead of
+                                 listing them at the end of the output''' )
     parser.add_argument( 'input', nargs='*' )
     args = parser.parse_args()
 
+    if args.chunk_size < 1:
+        parser.error( '--chunk_size must be at least 1' )
+
     args.snp_name_column -= 1
     args.rsid_column -= 1
     args.chromosome_column -= 1
@@ -66,55 +80,84 @@ can be specified if different from the default.''' ))
 
 ################################################################################
 #
-# get_inputs()
+# parse_input_line()
+# param: string; line of an input file
 # param: args
-# return: list either chrom:pos, snp_name, or rsid
+# return: chrom:pos, snp_name, or rsid; None for blank and comment lines
 #
 ################################################################################
-def get_inputs( args ):
-    inputs = []
+def parse_input_line( line, args ):
+    line = line.strip()
+    if not line: return None
+    if line.startswith( '#' ): return None
+
+    fields = line.split()
+    if args.input_type == 'chrom_pos':
+        chrom = fields[args.chromosome_column]
+        pos   = fields[args.position_column]
+        chrom = chrom.replace( 'chr', '' )
+        return '%s:%s' % ( chrom, pos )
+
+    elif args.input_type == 'snp_name':
+        return fields[args.snp_name_column]
+
+    elif args.input_type == 'rsid':
+        return fields[args.rsid_column]
 
+
+
+
+################################################################################
+#
+# iter_inputs()
+# inputs are read lazily, so a large file or stdin is never held in memory
+# param: args
+# return: iterator of chrom:pos, snp_name, or rsid
+#
+################################################################################
+def iter_inputs( args ):
     if args.input:
-        for idx in range( len( args.input ) ):
-            elem = args.input[idx]
-    
+        for elem in args.input:
             if os.path.isfile( elem ):
                 fh = open( elem )
                 for line in fh:
-                    line = line.strip()
-                    if not line: continue
-                    if line.startswith( '#' ): continue
-                
-                    if args.input_type == 'chrom_pos':
-                        fields = line.split()
-                        chrom = fields[args.chromosome_column]
-                        pos   = fields[args.position_column]
-                        chrom = chrom.replace( 'chr', '' )
-                        inputs.append( '%s:%s' % ( chrom, pos ) )
-                    elif args.input_type == 'snp_name':
-                        fields = line.split()
-                        snp_name = fields[args.snp_name_column]
-                        inputs.append( snp_name )
-
-                    elif args.input_type == 'rsid':
-                        fields = line.split()
-                        #line = line.replace( 'chr', '' )
-                        rsid = fields[args.rsid_column]
-                        inputs.append( rsid )
+                    elem = parse_input_line( line, args )
+                    if elem is not None:
+                        yield elem
+                fh.close()
 
             else:
                 if args.input_type == 'snp_name' or args.input_type == 'rsid':
-                    inputs.append( elem )
+                    yield elem
                 else:
                     sys.stderr.write( 'only rsIDs or snp_names can be stdin inputs' )
                     sys.exit()
-    elif select.select([sys.stdin,],[],[],0.0)[0]:
-        inputs = [ line.rstrip( '\n' ) for line in sys.stdin.readlines() ]
 
-    if not inputs:
-        raise ValueError( "No inputs" )
+    # a terminal means nothing was piped in
+    elif not sys.stdin.isatty():
+        # readline blocks until a whole line arrives, unlike iterating over
+        # sys.stdin, which waits to fill its read-ahead buffer
+        for line in iter( sys.stdin.readline, '' ):
+            line = line.strip()
+            if line and not line.startswith( '#' ):
+                yield line
 
-    return inputs    
+
+
+
+################################################################################
+#
+# iter_chunks()
+# param: iterator of inputs
+# param: int; chunk size
+# return: iterator of lists of inputs
+#
+################################################################################
+def iter_chunks( inputs, chunk_size ):
+    while True:
+        chunk = list( itertools.islice( inputs, chunk_size ) )
+        if not chunk: return
+        yield chunk
 
 
 
@@ -138,6 +181,47 @@ def get_cursor( db ):
     return curs
 
 
+
+
+################################################################################
+#
+# rsID conversion
+# dbsnp dbs made by build_snp_db.py store rsIDs as integers, in an rsid column,
+# older dbs store them as 'rsNNN' text in the name column. queries select
+# either as 'rsNNN', so output is the same for both layouts.
+#
+################################################################################
+
+# returns True if the dbsnp table has integer rsids
+def has_int_rsids( snp_curs ):
+    columns = [ row[1] for row in snp_curs.execute( 'PRAGMA table_info( dbsnp )' ) ]
+    return 'rsid' in columns
+
+
+# returns integer rsid of 'rsNNN' or 'NNN', None if not an rsID
+def rsid2int( rsid ):
+    if rsid[:2].lower() == 'rs':
+        rsid = rsid[2:]
+    if not rsid.isdigit():
+        return None
+
+    return int( rsid )
+
+
+def int2rsid( rsid ):
+    return 'rs%d' % ( rsid )
+
+
+# returns sql expression selecting the rsID as 'rsNNN'
+def get_name_column( int_rsid, prefix='' ):
+    if int_rsid:
+        return "'rs' || %srsid" % ( prefix )
+    else:
+        return '%sname' % ( prefix )
+
+
+
+
 def get_chrom_start_end( snp_name ):
     # snp_name could look like 
     #  chr1:1234
@@ -196,23 +280,26 @@ def get_chrom_start_end( snp_name ):
 # prep_input() 
 # param: list of inputs
 # param: string; input_type
+# param: boolean; for rsid input, also select snp class
+# param: boolean; dbsnp has integer rsids
 # return: tuple; sql statement, list of list of sql params
 #
 ################################################################################
-def prep_input( input_elem, input_type ):
+def prep_input( input_elem, input_type, get_class=False, int_rsid=False ):
     sql = ''
     params = []
+    name = get_name_column( int_rsid )
     if input_type == 'snp_name':
-        sql = '''SELECT name, chrom, chromStart, chromEnd, alleles FROM dbsnp 
-                 WHERE chrom = ? AND chromStart = ? AND chromEnd = ?'''
+        sql = '''SELECT {0}, chrom, chromStart, chromEnd, alleles FROM dbsnp 
+                 WHERE chrom = ? AND chromStart = ? AND chromEnd = ?'''.format( name )
 
         # elem could be snp_name like 1:1234_C/T or 1:1234 or 1:1234_CCC/A or 1:1234_C/AAAA
         chrom, start, end = get_chrom_start_end( input_elem )
         params = [ chrom, start, end ] 
             
     elif input_type == 'chrom_pos':
-        sql = '''SELECT name, chrom, chromStart, chromEnd, alleles FROM dbsnp 
-                 WHERE chrom = ? and chromEnd = ?'''
+        sql = '''SELECT {0}, chrom, chromStart, chromEnd, alleles FROM dbsnp 
+                 WHERE chrom = ? and chromEnd = ?'''.format( name )
         
         chrom, pos = input_elem.split( ':' )
         chrom = chrom.replace( 'chr', '' )
@@ -220,11 +307,16 @@ def prep_input( input_elem, input_type ):
         params = [ chrom, pos ]
 
     elif input_type == 'rsid':
-        sql = 'SELECT name, chrom, chromStart, chromEnd, alleles'
-        if args.get_class:
+        sql = 'SELECT %s, chrom, chromStart, chromEnd, alleles' % ( name )
+        if get_class:
             sql += ', class'
-        sql += ' FROM dbsnp WHERE name = ?'
-        params = [ input_elem ]
+        if int_rsid:
+            # not an rsID binds NULL, which matches nothing
+            sql += ' FROM dbsnp WHERE rsid = ?'
+            params = [ rsid2int( input_elem ) ]
+        else:
+            sql += ' FROM dbsnp WHERE name = ?'
+            params = [ input_elem ]
 
     else:
         sys.stderr.write( 'Bad input type: "%s"\n' % ( input_type ) )
@@ -236,12 +328,29 @@ def prep_input( input_elem, input_type ):
 
 
 
-def get_merge_output( rsid ):
-    rsid = int( rsid.replace( 'rs', '' ) )
+MERGE_SQL = '''SELECT DISTINCT rsCurrent from rs_merge 
+               WHERE rsLow = ? or rsHigh = ?'''
+
+# merge dbs made by build_snp_db.py also have rs_current, with every merge
+# chain already followed to its end
+RS_CURRENT_SQL = 'SELECT rsCurrent FROM rs_current WHERE rsid = ?'
+
+# returns True if the merge db has the rs_current table
+def has_rs_current( rsid_curs ):
+    rsid_curs.execute( '''SELECT name FROM sqlite_master 
+                          WHERE name = 'rs_current' AND type = 'table' ''' )
+    return rsid_curs.fetchone() is not None
 
-    rsid_sql = '''SELECT DISTINCT rsCurrent from rs_merge 
-                  WHERE rsLow = ? or rsHigh = ?'''
-    rsid_curs.execute( rsid_sql, [ rsid, rsid ] )
+
+def get_merge_output( rsid, closure=False ):
+    rsid = rsid2int( rsid )
+    if rsid is None:
+        return []
+
+    if closure:
+        rsid_curs.execute( RS_CURRENT_SQL, [ rsid ] )
+    else:
+        rsid_curs.execute( MERGE_SQL, [ rsid, rsid ] )
     rows = rsid_curs.fetchall()
 
     return rows
@@ -261,77 +370,235 @@ def get_snp_output( snp_curs, sql, param ):
 
 
 
-
 ################################################################################
+#
+# load_batch_inputs()
+# load the parsed inputs into a temp table, in one executemany
+# param: sqlite3 cursor
+# param: list of inputs
+# param: string; input_type
+# return: nothing
+#
 ################################################################################
-##
-## main
-##
+def load_batch_inputs( snp_curs, inputs, input_type ):
+    snp_curs.execute( 'DROP TABLE IF EXISTS temp.batch_inputs' )
+    snp_curs.execute( '''CREATE TEMP TABLE batch_inputs 
+                         ( idx INTEGER PRIMARY KEY, name TEXT, rsid INTEGER, chrom TEXT, 
+                           chromStart INTEGER, chromEnd INTEGER )''' )
+
+    def iter_rows():
+        for idx, elem in enumerate( inputs ):
+            if input_type == 'snp_name':
+                chrom, start, end = get_chrom_start_end( elem )
+                yield ( idx, None, None, chrom, start, end )
+            elif input_type == 'chrom_pos':
+                chrom, pos = elem.split( ':' )
+                chrom = 'chr%s' % ( chrom.replace( 'chr', '' ) )
+                # bound as given, like the per input query: integer affinity
+                # converts a number, and anything else, eg a header, matches nothing
+                yield ( idx, None, None, chrom, None, pos )
+            else:
+                yield ( idx, elem, rsid2int( elem ), None, None, None )
+
+    snp_curs.executemany( 'INSERT INTO batch_inputs VALUES ( ?, ?, ?, ?, ?, ? )', iter_rows() )
+
+
+
 ################################################################################
+#
+# get_batch_output()
+# resolve every input with one join against dbsnp
+# param: sqlite3 cursor
+# param: list of inputs
+# param: string; input_type
+# param: boolean; for rsid input, also select snp class
+# param: boolean; dbsnp has integer rsids
+# return: dict of input index to list of db rows
+#
 ################################################################################
+def get_batch_output( snp_curs, inputs, input_type, get_class=False, int_rsid=False ):
+    load_batch_inputs( snp_curs, inputs, input_type )
+
+    columns = 'i.idx, %s, d.chrom, d.chromStart, d.chromEnd, d.alleles' % (
+        get_name_column( int_rsid, 'd.' ) )
+    if input_type == 'snp_name':
+        on = 'd.chrom = i.chrom AND d.chromStart = i.chromStart AND d.chromEnd = i.chromEnd'
+    elif input_type == 'chrom_pos':
+        on = 'd.chrom = i.chrom AND d.chromEnd = i.chromEnd'
+    elif int_rsid:
+        on = 'd.rsid = i.rsid'
+    else:
+        on = 'd.name = i.name'
+    if input_type == 'rsid' and get_class:
+        columns += ', d.class'
 
-args = parse_args()
-try:
-    inputs = get_inputs( args )
-except ValueError, e:
-    sys.stderr.write( "No inputs specified\n" )
-    sys.exit()
+    # inputs drive the join, so each one is an index probe into dbsnp
+    sql = '''SELECT {0} FROM batch_inputs i CROSS JOIN dbsnp d ON {1}
+             ORDER BY i.idx'''.format( columns, on )
 
-snp_curs = get_cursor( args.snp_db )
+    idx2rows = defaultdict( list )
+    for row in snp_curs.execute( sql ):
+        idx2rows[row[0]].append( row[1:] )
 
-if args.input_type == 'rsid':
-    rsid_curs = get_cursor( args.merge_db )
+    snp_curs.execute( 'DROP TABLE temp.batch_inputs' )
+
+    return idx2rows
 
-found = []
-not_found = []
-for elem in inputs:
-    sql, param = prep_input( elem, args.input_type )
 
-    rows = get_snp_output( snp_curs, sql, param )
-    if rows:
-        for row in rows:
-            found.append( [elem] + list( row ) )
 
+
+################################################################################
+#
+# get_batch_merge_output()
+# resolve retired rsIDs with one join against the merge db, then look up the
+# current rsIDs with one join against dbsnp
+# param: sqlite3 cursor of snp db
+# param: sqlite3 cursor of merge db
+# param: list of inputs
+# param: list of indexes of the inputs to resolve
+# param: boolean; for rsid input, also select snp class
+# param: boolean; dbsnp has integer rsids
+# param: boolean; merge db has rs_current
+# return: dict of input index to list of db rows
+#
+################################################################################
+def get_batch_merge_output( snp_curs, rsid_curs, inputs, idxs, get_class=False,
+                            int_rsid=False, closure=False ):
+    rsid_curs.execute( 'DROP TABLE IF EXISTS temp.merge_inputs' )
+    rsid_curs.execute( '''CREATE TEMP TABLE merge_inputs 
+                          ( idx INTEGER PRIMARY KEY, rsid INTEGER )''' )
+    rsid_curs.executemany( 'INSERT INTO merge_inputs VALUES ( ?, ? )',
+                           ( ( idx, rsid2int( inputs[idx] ) ) for idx in idxs ) )
+
+    if closure:
+        sql = '''SELECT i.idx, m.rsCurrent FROM merge_inputs i 
+                 CROSS JOIN rs_current m ON m.rsid = i.rsid'''
     else:
-        # sometimes get a retired rsID, check for new
+        # one join per side of the OR, so each can use its index
+        sql = '''SELECT i.idx, m.rsCurrent FROM merge_inputs i 
+                 CROSS JOIN rs_merge m ON m.rsHigh = i.rsid
+                 UNION
+                 SELECT i.idx, m.rsCurrent FROM merge_inputs i 
+                 CROSS JOIN rs_merge m ON m.rsLow = i.rsid'''
+    merged = rsid_curs.execute( sql ).fetchall()
+    rsid_curs.execute( 'DROP TABLE temp.merge_inputs' )
+
+    current = [ int2rsid( rs_current ) for idx, rs_current in merged ]
+    current2rows = get_batch_output( snp_curs, current, 'rsid', get_class, int_rsid )
+
+    idx2rows = defaultdict( list )
+    for i, ( idx, rs_current ) in enumerate( merged ):
+        idx2rows[idx].extend( current2rows.get( i, [] ) )
+
+    return idx2rows
+
+
+
+
+################################################################################
+#
+# resolve_chunk()
+# look up a chunk of inputs, per input or with --batch in one join
+# param: sqlite3 cursor of snp db
+# param: list of inputs
+# param: args
+# param: boolean; dbsnp has integer rsids
+# param: boolean; merge db has rs_current
+# return: list of tuples; input, list of db rows, empty if not found
+#
+################################################################################
+def resolve_chunk( snp_curs, chunk, args, int_rsid, closure ):
+    if args.batch:
+        idx2rows = get_batch_output( snp_curs, chunk, args.input_type, args.get_class,
+                                     int_rsid )
+
+        # sometimes get retired rsIDs, check all of them for new at once
         if args.input_type == 'rsid':
-            rows = get_merge_output( elem )
+            missing = [ idx for idx in range( len( chunk ) ) if idx not in idx2rows ]
+            idx2rows.update( get_batch_merge_output( snp_curs, rsid_curs, chunk, missing,
+                                                     args.get_class, int_rsid, closure ) )
 
-            if rows:
-                for row in rows:
-                    rs_current = 'rs%d' % ( row[0] )
-                    snp_rows = get_snp_output( snp_curs, sql, [rs_current] )
-
-                    if snp_rows:
-                        for snp_row in snp_rows:
-                            found.append( [elem] + list( snp_row ) )
-                    
-                    else:
-                        not_found.append( elem )
-            else:
-                not_found.append( elem )
+        return [ ( elem, idx2rows.get( idx, [] ) ) for idx, elem in enumerate( chunk ) ]
 
-        else:
-            not_found.append( elem )
+    results = []
+    for elem in chunk:
+        sql, param = prep_input( elem, args.input_type, args.get_class, int_rsid )
+        rows = get_snp_output( snp_curs, sql, param ) or []
+
+        # sometimes get a retired rsID, check for new
+        if not rows and args.input_type == 'rsid':
+            for row in get_merge_output( elem, closure ):
+                rs_current = row[0] if int_rsid else int2rsid( row[0] )
+                rows.extend( get_snp_output( snp_curs, sql, [rs_current] ) or [] )
+
+        results.append( ( elem, rows ) )
+
+    return results
+
+
+
+
+################################################################################
+################################################################################
+##
+## main
+##
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    inputs = iter_inputs( args )
+    try:
+        first = next( inputs )
+    except StopIteration:
+        sys.stderr.write( "No inputs specified\n" )
+        sys.exit()
+    inputs = itertools.chain( [first], inputs )
+
+    snp_curs = get_cursor( args.snp_db )
+    int_rsid = has_int_rsids( snp_curs )
 
+    closure = False
+    if args.input_type == 'rsid':
+        rsid_curs = get_cursor( args.merge_db )
+        closure = has_rs_current( rsid_curs )
 
-print '# db: %s' % ( args.snp_db )
-if not_found:
-    print '# these identifiers were not found in the db'
-    for elem in not_found:
-        print '# %s' % ( elem )
-    print
+    # not found ids go to a side file, or are spooled and listed at the end
+    if args.not_found_file:
+        not_found_fh = open( args.not_found_file, 'w' )
+    else:
+        not_found_fh = tempfile.TemporaryFile()
+    n_not_found = 0
 
+    print '# db: %s' % ( args.snp_db )
 
-if found:
     labels = [ '# input', 'current_rsID', 'chrom', 'start_position', 'end_position', 'alleles' ]
     if args.input_type == 'rsid' and args.get_class:
         labels.append( 'class' )
-
     print '\t'.join( labels )
-                       
-    for entry in found:
-        print '\t'.join( map( str, entry ) )
 
-        
+    for chunk in iter_chunks( inputs, args.chunk_size ):
+        for elem, rows in resolve_chunk( snp_curs, chunk, args, int_rsid, closure ):
+            if rows:
+                for row in rows:
+                    print '\t'.join( map( str, [elem] + list( row ) ) )
+            else:
+                not_found_fh.write( '%s\n' % ( elem ) )
+                n_not_found += 1
+
+        sys.stdout.flush()
+
+    if n_not_found:
+        print
+        if args.not_found_file:
+            print '# %d identifiers were not found in the db, see %s' % ( n_not_found,
+                                                                          args.not_found_file )
+        else:
+            print '# these identifiers were not found in the db'
+            not_found_fh.seek( 0 )
+            for line in not_found_fh:
+                print '# %s' % ( line.rstrip( '\n' ) )
 
+    not_found_fh.close()